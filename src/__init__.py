@@ -7,8 +7,9 @@ __license__ = 'GPL v3'
 __copyright__ = '2012, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import os
+import os, shutil, time
 from collections import namedtuple
+from multiprocessing import cpu_count
 
 from calibre import strftime
 from calibre.customize import CatalogPlugin
@@ -22,6 +23,30 @@ from calibre.utils.localization import calibre_langcode_to_name, canonicalize_la
 Option = namedtuple('Option', 'option, default, dest, action, help')
 
 
+class StageTimer(object):
+    ''' Progress reporter logging the time spent in each conversion stage '''
+
+    def __init__(self, log, notification):
+        self.log = log
+        self.notification = notification
+        self.stage = None
+        self.started = time.time()
+
+    def __call__(self, fraction, msg=''):
+        if msg and msg != self.stage:
+            self.finish()
+            self.stage = msg
+        self.notification(fraction, msg)
+
+    def finish(self):
+        ''' Log the time spent in the current stage '''
+        now = time.time()
+        if self.stage:
+            self.log.info(" %s: %.2fs" % (self.stage.rstrip('.'), now - self.started))
+        self.started = now
+        self.stage = None
+
+
 class MAGIC_MOBI(CatalogPlugin):
     'Magic Mobi catalog generator'
 
@@ -36,6 +61,23 @@ class MAGIC_MOBI(CatalogPlugin):
     THUMB_SMALLEST = "1.0"
     THUMB_LARGEST = "2.0"
 
+    # Conversion settings for the generated sources. The catalog is already
+    # normalized XHTML with its own NCX: heuristics, structure detection and
+    # punctuation rewriting are skipped. Font rescaling and image resizing
+    # are kept, as they shape the output, leaving the OEB input, CSS
+    # flattening and MOBI output stages. StageTimer logs their timings on
+    # each run, see README.rst.
+    CONVERSION_RECOMMENDATIONS = [('chapter', '/'),
+                                  ('chapter_mark', 'none'),
+                                  ('enable_heuristics', False),
+                                  ('input_encoding', 'utf-8'),
+                                  ('max_toc_links', 0),
+                                  ('no_chapters_in_toc', True),
+                                  ('page_breaks_before', '/'),
+                                  ('remove_fake_margins', False),
+                                  ('smarten_punctuation', False),
+                                  ('unsmarten_punctuation', False)]
+
     cli_options = [Option('--catalog-title',  # {{{
                           default='My Books',
                           dest='catalog_title',
@@ -90,9 +132,177 @@ class MAGIC_MOBI(CatalogPlugin):
                           "Range: 1.0 - 2.0\n"
                           "Default: '%default'\n"
                           "Applies to AZW3, MOBI output formats")),
+                   Option('--incremental-build',
+                          default=False,
+                          dest='incremental_build',
+                          action='store_true',
+                          help=_("Keep the catalog sources of this library between builds and only "
+                          "regenerate the pages affected by changed, added or removed books.\n"
+                          "Default: '%default'\n"
+                          "Applies to: MOBI output format")),
+                   Option('--worker-count',
+                          default='1',
+                          dest='worker_count',
+                          action=None,
+                          help=_("Number of worker processes rendering the Descriptions section. "
+                          "0 uses one worker per CPU core.\n"
+                          "Default: '%default'\n"
+                          "Applies to: MOBI output format")),
+                   Option('--thumb-cache-age',
+                          default='5',
+                          dest='thumb_cache_age',
+                          action=None,
+                          help=_("Number of builds after which thumbnails no longer used by the "
+                          "catalog are evicted from the thumbnail cache. 0 keeps them.\n"
+                          "Default: '%default'\n"
+                          "Applies to: MOBI output format")),
+                   Option('--thumb-cache-size',
+                          default='0',
+                          dest='thumb_cache_size',
+                          action=None,
+                          help=_("Size limit (in MB) of the thumbnail cache. Least recently used "
+                          "thumbnails are evicted above the limit. 0 is unlimited.\n"
+                          "Default: '%default'\n"
+                          "Applies to: MOBI output format")),
+                   Option('--descriptions-per-file',
+                          default='1',
+                          dest='descriptions_per_file',
+                          action=None,
+                          help=_("Number of book Descriptions packed into one content file. "
+                          "Fewer, larger files convert faster and page faster on the device.\n"
+                          "Default: '%default'\n"
+                          "Applies to: MOBI output format")),
+                   Option('--volume-split',
+                          default='',
+                          dest='volume_split',
+                          action=None,
+                          help=_("Split the catalog into volumes by 'author' initial, first 'genre' "
+                          "or 'size'. The catalog output becomes an index volume listing the volumes. "
+                          "Empty builds a single catalog.\n"
+                          "Default: '%default'\n"
+                          "Applies to: MOBI output format")),
+                   Option('--volume-size',
+                          default='2000',
+                          dest='volume_size',
+                          action=None,
+                          help=_("Target number of books per volume. Author initials are merged "
+                          "into volumes up to this size, 'size' volumes hold this many books. "
+                          "0 gives each author initial its own volume.\n"
+                          "Default: '%default'\n"
+                          "Applies to: MOBI output format")),
+                   Option('--volume-dir',
+                          default=None,
+                          dest='volume_dir',
+                          action=None,
+                          help=_("Directory the volumes are written to.\n"
+                          "Default: the directory of the catalog output\n"
+                          "Applies to: MOBI output format")),
+                   Option('--volume-url',
+                          default=None,
+                          dest='volume_url',
+                          action=None,
+                          help=_("URL of the volume directory, used for links in the index volume.\n"
+                          "Default: '%default'\n"
+                          "Applies to: MOBI output format")),
                           ]
     # }}}
 
+    def convert_catalog(self, catalog_path, path_to_output, opts, db, notification=DummyReporter()):
+        """ Convert generated catalog sources to the output format.
+
+        Args:
+         catalog_path (str): directory of the generated OPF, NCX and content
+         path_to_output (str): output file
+         opts (object): build options
+         db: calibre database
+         notification: progress reporter
+        """
+        log = opts.log
+        recommendations = [(name, value, OptionRecommendation.HIGH)
+                           for (name, value) in self.CONVERSION_RECOMMENDATIONS]
+        recommendations.append(('comments', '', OptionRecommendation.HIGH))
+
+        """
+        >>> Use to debug generated catalog code before pipeline conversion <<<
+        """
+        GENERATE_DEBUG_EPUB = False
+        if GENERATE_DEBUG_EPUB:
+            catalog_debug_path = os.path.join(os.path.expanduser('~'), 'Desktop', 'Catalog debug')
+            setattr(opts, 'debug_pipeline', os.path.expanduser(catalog_debug_path))
+
+        # Verbose conversion logs only when debugging the pipeline
+        dp = getattr(opts, 'debug_pipeline', None)
+        if dp is not None:
+            recommendations.append(('debug_pipeline', dp,
+                OptionRecommendation.HIGH))
+            recommendations.append(('verbose', 2, OptionRecommendation.HIGH))
+
+        if opts.output_profile and opts.output_profile.startswith("kindle"):
+            recommendations.append(('output_profile', opts.output_profile,
+                OptionRecommendation.HIGH))
+            recommendations.append(('book_producer', opts.output_profile,
+                OptionRecommendation.HIGH))
+            if opts.fmt == 'mobi':
+                recommendations.append(('no_inline_toc', True,
+                    OptionRecommendation.HIGH))
+
+        # Use existing cover or generate new cover
+        cpath = None
+        existing_cover = False
+        # Volumes are converted in forked workers, keep them off the database
+        if opts.use_existing_cover:
+            try:
+                search_text = 'title:"%s" author:%s' % (
+                        opts.catalog_title.replace('"', '\\"'), 'calibre')
+                matches = db.search(search_text, return_matches=True)
+                if matches:
+                    cpath = db.cover(matches[0], index_is_id=True, as_path=True)
+                    if cpath and os.path.exists(cpath):
+                        existing_cover = True
+            except:
+                pass
+
+        if opts.use_existing_cover and not existing_cover:
+            log.warning("no existing catalog cover found")
+
+        if opts.use_existing_cover and existing_cover:
+            recommendations.append(('cover', cpath, OptionRecommendation.HIGH))
+            log.info("using existing catalog cover")
+        else:
+            log.info("replacing catalog cover")
+            new_cover_path = PersistentTemporaryFile(suffix='.jpg')
+            new_cover = calibre_cover(opts.catalog_title.replace('"', '\\"'), 'calibre')
+            new_cover_path.write(new_cover)
+            new_cover_path.close()
+            recommendations.append(('cover', new_cover_path.name, OptionRecommendation.HIGH))
+
+        # Run ebook-convert
+        from calibre.ebooks.conversion.plumber import Plumber
+        timer = StageTimer(log, notification)
+        plumber = Plumber(os.path.join(catalog_path, opts.basename + '.opf'),
+                        path_to_output, log, report_progress=timer,
+                        abort_after_input_dump=False)
+        plumber.merge_ui_recommendations(recommendations)
+        plumber.run()
+        timer.finish()
+
+        try:
+            os.remove(cpath)
+        except:
+            pass
+
+        if GENERATE_DEBUG_EPUB:
+            from calibre.ebooks.epub import initialize_container
+            from calibre.ebooks.tweak import zip_rebuilder
+            from calibre.utils.zipfile import ZipFile
+            input_path = os.path.join(catalog_debug_path, 'input')
+            epub_shell = os.path.join(catalog_debug_path, 'epub_shell.zip')
+            initialize_container(epub_shell, opf_name='content.opf')
+            with ZipFile(epub_shell, 'r') as zf:
+                zf.extractall(path=input_path)
+            os.remove(epub_shell)
+            zip_rebuilder(input_path, os.path.join(catalog_debug_path, 'input.epub'))
+
     def run(self, path_to_output, opts, db, notification=DummyReporter()):
         from calibre_plugins.magic_mobi.generate import CatalogBuilder
         from calibre.utils.logging import default_log as log
@@ -197,6 +407,48 @@ class MAGIC_MOBI(CatalogPlugin):
             log.error("coercing thumb_width from '%s' to '%s'" % (opts.thumb_width, self.THUMB_SMALLEST))
             opts.thumb_width = "1.0"
 
+        # Limit worker_count to 1 - number of CPU cores
+        try:
+            opts.worker_count = int(opts.worker_count)
+            if opts.worker_count < 1 or opts.worker_count > cpu_count():
+                opts.worker_count = cpu_count()
+        except:
+            log.error("coercing worker_count from '%s' to '1'" % opts.worker_count)
+            opts.worker_count = 1
+
+        # Limit thumb_cache_age, thumb_cache_size to >= 0
+        try:
+            opts.thumb_cache_age = max(int(opts.thumb_cache_age), 0)
+        except:
+            log.error("coercing thumb_cache_age from '%s' to '5'" % opts.thumb_cache_age)
+            opts.thumb_cache_age = 5
+        try:
+            opts.thumb_cache_size = max(int(opts.thumb_cache_size), 0)
+        except:
+            log.error("coercing thumb_cache_size from '%s' to '0'" % opts.thumb_cache_size)
+            opts.thumb_cache_size = 0
+
+        # Limit descriptions_per_file to >= 1
+        try:
+            opts.descriptions_per_file = max(int(opts.descriptions_per_file), 1)
+        except:
+            log.error("coercing descriptions_per_file from '%s' to '1'" % opts.descriptions_per_file)
+            opts.descriptions_per_file = 1
+
+        # Limit volume_split to author, genre, size, volume_size to >= 0
+        if opts.volume_split:
+            opts.volume_split = opts.volume_split.strip().lower()
+            if opts.volume_split not in ['author', 'genre', 'size']:
+                log.error("unknown volume_split '%s', building a single catalog" % opts.volume_split)
+                opts.volume_split = ''
+        try:
+            opts.volume_size = max(int(opts.volume_size), 0)
+        except:
+            log.error("coercing volume_size from '%s' to '2000'" % opts.volume_size)
+            opts.volume_size = 2000
+        if opts.volume_split == 'size' and not opts.volume_size:
+            opts.volume_size = 2000
+
         # eval exclusion_rules if passed from command line
         if type(opts.exclusion_tags) is not list:
             log.info(type(opts.exclusion_tags))
@@ -212,16 +464,25 @@ class MAGIC_MOBI(CatalogPlugin):
         build_log.append(" opts:")
         for key in keys:
             if key in ['catalog_title', 'author_clip', 'connected_kindle', 'creator',
-                       'description_clip', 
-                       'exclusion_tags', 'fmt',
+                       'description_clip', 'descriptions_per_file',
+                       'exclusion_tags', 'fmt', 'incremental_build',
                        'output_profile',
                        'search_text', 'sort_by', 'sync',
-                       'thumb_width', 'use_existing_cover', 'wishlist_tag']:
+                       'thumb_cache_age', 'thumb_cache_size',
+                       'thumb_width', 'use_existing_cover',
+                       'volume_dir', 'volume_size', 'volume_split', 'volume_url',
+                       'wishlist_tag', 'worker_count']:
                 build_log.append("  %s: %s" % (key, repr(opts_dict[key])))
         if opts.verbose:
             log('\n'.join(line for line in build_log))
         self.opts = opts
 
+        if opts.volume_split:
+            # Volumes are built and converted by the volume builder, the output
+            # is the index volume
+            from calibre_plugins.magic_mobi.volumes import VolumeBuilder
+            return VolumeBuilder(self, db, opts, path_to_output, notification).build()
+
         # Launch the Catalog builder
         catalog = CatalogBuilder(db, opts, self, report_progress=notification)
 
@@ -229,9 +490,10 @@ class MAGIC_MOBI(CatalogPlugin):
             log.info(" Begin catalog source generation")
 
         try:
-            catalog.build_sources()
-            if opts.verbose:
-                log.info(" Completed catalog source generation\n")
+            if catalog.cached_output is None:
+                catalog.build_sources()
+                if opts.verbose:
+                    log.info(" Completed catalog source generation\n")
         except (AuthorSortMismatchException, EmptyCatalogException), e:
             log.error(" *** Terminated catalog generation: %s ***" % e)
         except:
@@ -239,87 +501,15 @@ class MAGIC_MOBI(CatalogPlugin):
             raise
 
         else:
-            recommendations = []
-            recommendations.append(('remove_fake_margins', False,
-                OptionRecommendation.HIGH))
-            recommendations.append(('comments', '', OptionRecommendation.HIGH))
-
-            """
-            >>> Use to debug generated catalog code before pipeline conversion <<<
-            """
-            GENERATE_DEBUG_EPUB = False
-            if GENERATE_DEBUG_EPUB:
-                catalog_debug_path = os.path.join(os.path.expanduser('~'), 'Desktop', 'Catalog debug')
-                setattr(opts, 'debug_pipeline', os.path.expanduser(catalog_debug_path))
-
-            dp = getattr(opts, 'debug_pipeline', None)
-            if dp is not None:
-                recommendations.append(('debug_pipeline', dp,
-                    OptionRecommendation.HIGH))
-
-            if opts.output_profile and opts.output_profile.startswith("kindle"):
-                recommendations.append(('output_profile', opts.output_profile,
-                    OptionRecommendation.HIGH))
-                recommendations.append(('book_producer', opts.output_profile,
-                    OptionRecommendation.HIGH))
-                if opts.fmt == 'mobi':
-                    recommendations.append(('no_inline_toc', True,
-                        OptionRecommendation.HIGH))
-                    recommendations.append(('verbose', 2,
-                        OptionRecommendation.HIGH))
-
-            # Use existing cover or generate new cover
-            cpath = None
-            existing_cover = False
-            try:
-                search_text = 'title:"%s" author:%s' % (
-                        opts.catalog_title.replace('"', '\\"'), 'calibre')
-                matches = db.search(search_text, return_matches=True)
-                if matches:
-                    cpath = db.cover(matches[0], index_is_id=True, as_path=True)
-                    if cpath and os.path.exists(cpath):
-                        existing_cover = True
-            except:
-                pass
-
-            if self.opts.use_existing_cover and not existing_cover:
-                log.warning("no existing catalog cover found")
-
-            if self.opts.use_existing_cover and existing_cover:
-                recommendations.append(('cover', cpath, OptionRecommendation.HIGH))
-                log.info("using existing catalog cover")
+            if catalog.cached_output is not None:
+                log.info(" library unchanged, reusing catalog '%s'" % catalog.cached_output)
+                shutil.copyfile(catalog.cached_output, path_to_output)
             else:
-                log.info("replacing catalog cover")
-                new_cover_path = PersistentTemporaryFile(suffix='.jpg')
-                new_cover = calibre_cover(opts.catalog_title.replace('"', '\\"'), 'calibre')
-                new_cover_path.write(new_cover)
-                new_cover_path.close()
-                recommendations.append(('cover', new_cover_path.name, OptionRecommendation.HIGH))
-
-            # Run ebook-convert
-            from calibre.ebooks.conversion.plumber import Plumber
-            plumber = Plumber(os.path.join(catalog.catalog_path, opts.basename + '.opf'),
-                            path_to_output, log, report_progress=notification,
-                            abort_after_input_dump=False)
-            plumber.merge_ui_recommendations(recommendations)
-            plumber.run()
-
-            try:
-                os.remove(cpath)
-            except:
-                pass
+                self.convert_catalog(catalog.catalog_path, path_to_output, opts, db, notification)
+                catalog.save_output(path_to_output)
 
-            if GENERATE_DEBUG_EPUB:
-                from calibre.ebooks.epub import initialize_container
-                from calibre.ebooks.tweak import zip_rebuilder
-                from calibre.utils.zipfile import ZipFile
-                input_path = os.path.join(catalog_debug_path, 'input')
-                epub_shell = os.path.join(catalog_debug_path, 'epub_shell.zip')
-                initialize_container(epub_shell, opf_name='content.opf')
-                with ZipFile(epub_shell, 'r') as zf:
-                    zf.extractall(path=input_path)
-                os.remove(epub_shell)
-                zip_rebuilder(input_path, os.path.join(catalog_debug_path, 'input.epub'))
+        finally:
+            catalog.release_cache_dir()
 
         # returns to gui2.actions.catalog:catalog_generated()
         return catalog.error
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import with_statement
+
+__license__   = 'GPL v3'
+__copyright__ = '2013, yosssoy <yossoy@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os, sqlite3, time
+
+
+class ThumbnailCache(object):
+    '''
+    Persistent thumbnail store keyed by book uuid and cover fingerprint.
+
+    Thumbs are kept in a sqlite database opened once per build. Thumbs of
+    several pixel dimensions ('WxH') are kept side by side, a store instance
+    serves the dimensions it was opened with. The key index of those is
+    loaded into memory when the store is opened, so lookups don't touch
+    the disk. New thumbs are committed in batches of BATCH_SIZE.
+
+    A validity marker for the dimensions is written after a complete
+    thumbnail pass. Thumbs of dimensions without a marker are discarded,
+    which allows detection of aborted catalog builds.
+
+    The crc of each cover is recorded with the cover's path, size and mtime,
+    so unchanged covers need not be read to form the thumb key. A cover
+    modified within RACY_WINDOW seconds of being recorded may change again
+    without a visible mtime change, its crc is not trusted.
+
+    Each opening of the store counts as a build. Thumbs and covers record
+    the last build they were used in, compact() evicts entries by age and
+    by total size.
+    '''
+
+    BATCH_SIZE = 200
+    SCHEMA_VERSION = 3
+    # Seconds, covers FAT mtime resolution
+    RACY_WINDOW = 2
+
+    def __init__(self, path, dimensions):
+        self.path = path
+        self.dimensions = dimensions
+        self.pending = {}
+        self.pending_covers = {}
+        self.used = set()
+        self.used_covers = set()
+        try:
+            self._open()
+        except sqlite3.DatabaseError:
+            # Unreadable store, start over
+            self.close()
+            os.remove(self.path)
+            self._open()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def _open(self):
+        self.conn = sqlite3.connect(self.path)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                          '(name TEXT PRIMARY KEY, value TEXT)')
+        row = self.conn.execute("SELECT value FROM meta WHERE name='schema_version'").fetchone()
+        version = int(row[0]) if row is not None else 1
+        if version < 2:
+            # Thumbs of earlier versions are not kept by dimensions
+            self.conn.execute('DROP TABLE IF EXISTS thumbs')
+            self.conn.execute('DELETE FROM meta')
+        if version < 3:
+            # Entries of earlier versions were not aged
+            tables = set(row[0] for row in
+                         self.conn.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+            for table in ('thumbs', 'covers'):
+                if table in tables:
+                    self.conn.execute('ALTER TABLE %s ADD COLUMN last_used INTEGER NOT NULL DEFAULT 0' %
+                                      table)
+        if version != self.SCHEMA_VERSION:
+            self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('schema_version', ?)",
+                              (str(self.SCHEMA_VERSION),))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS thumbs '
+                          '(uuid TEXT NOT NULL, dimensions TEXT NOT NULL, fingerprint TEXT NOT NULL, '
+                          'data BLOB NOT NULL, last_used INTEGER NOT NULL DEFAULT 0, '
+                          'PRIMARY KEY (uuid, dimensions, fingerprint))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS covers '
+                          '(uuid TEXT PRIMARY KEY, path TEXT, size INTEGER, mtime REAL, '
+                          'fingerprint TEXT, recorded REAL, last_used INTEGER NOT NULL DEFAULT 0)')
+        row = self.conn.execute("SELECT value FROM meta WHERE name='build'").fetchone()
+        self.build = (int(row[0]) if row is not None else 0) + 1
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('build', ?)",
+                          (str(self.build),))
+        self.conn.commit()
+        self.index = set(self.conn.execute('SELECT uuid, fingerprint FROM thumbs '
+                                           'WHERE dimensions=?', (self.dimensions,)))
+        self.covers = dict((row[0], tuple(row[1:])) for row in
+                           self.conn.execute('SELECT uuid, path, size, mtime, fingerprint, recorded '
+                                             'FROM covers'))
+
+    def clear(self):
+        ''' Remove all thumbs of the dimensions and their validity marker '''
+        self.pending = {}
+        self.conn.execute('DELETE FROM thumbs WHERE dimensions=?', (self.dimensions,))
+        self.conn.execute('DELETE FROM meta WHERE name=?', ('valid:' + self.dimensions,))
+        self.conn.commit()
+        self.index = set()
+
+    def close(self):
+        ''' Commit pending thumbs, close the store '''
+        if getattr(self, 'conn', None) is not None:
+            try:
+                self.commit()
+            finally:
+                self.conn.close()
+                self.conn = None
+
+    def commit(self):
+        ''' Write pending thumbs, covers and usage in a single transaction '''
+        if self.pending:
+            self.conn.executemany('INSERT OR REPLACE INTO thumbs '
+                                  '(uuid, dimensions, fingerprint, data, last_used) '
+                                  'VALUES (?, ?, ?, ?, ?)',
+                                  [(uuid, self.dimensions, fingerprint, data, self.build)
+                                   for ((uuid, fingerprint), data) in self.pending.iteritems()])
+            self.pending = {}
+        if self.pending_covers:
+            self.conn.executemany('INSERT OR REPLACE INTO covers '
+                                  '(uuid, path, size, mtime, fingerprint, recorded, last_used) '
+                                  'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  [(uuid,) + entry + (self.build,)
+                                   for (uuid, entry) in self.pending_covers.iteritems()])
+            self.pending_covers = {}
+        if self.used:
+            # Thumbs of other dimensions of a current cover stay in use
+            self.conn.executemany('UPDATE thumbs SET last_used=? WHERE uuid=? AND fingerprint=?',
+                                  [(self.build, uuid, fingerprint) for (uuid, fingerprint) in self.used])
+            self.used = set()
+        if self.used_covers:
+            self.conn.executemany('UPDATE covers SET last_used=? WHERE uuid=?',
+                                  [(self.build, uuid) for uuid in self.used_covers])
+            self.used_covers = set()
+        self.conn.commit()
+
+    def compact(self, max_age, max_bytes):
+        '''
+        Evict thumbs and covers not used in the last max_age builds, then
+        least recently used thumbs of earlier builds until the thumbs total
+        at most max_bytes. 0 disables either limit.
+        Uses its own connection, may run in a background thread once the
+        store is closed. Returns the number of thumbs evicted.
+        '''
+        conn = sqlite3.connect(self.path)
+        try:
+            evicted = 0
+            if max_age:
+                evicted += conn.execute('DELETE FROM thumbs WHERE last_used <= ?',
+                                        (self.build - max_age,)).rowcount
+                conn.execute('DELETE FROM covers WHERE last_used <= ?', (self.build - max_age,))
+            if max_bytes:
+                total = conn.execute('SELECT SUM(LENGTH(data)) FROM thumbs').fetchone()[0] or 0
+                expired = []
+                for (rowid, length) in conn.execute('SELECT rowid, LENGTH(data) FROM thumbs '
+                                                    'WHERE last_used < ? ORDER BY last_used',
+                                                    (self.build,)):
+                    if total <= max_bytes:
+                        break
+                    expired.append((rowid,))
+                    total -= length
+                conn.executemany('DELETE FROM thumbs WHERE rowid=?', expired)
+                evicted += len(expired)
+            conn.commit()
+            if evicted:
+                conn.execute('VACUUM')
+            return evicted
+        finally:
+            conn.close()
+
+    def get(self, uuid, fingerprint):
+        ''' Return thumb data, or None if not cached '''
+        if (uuid, fingerprint) not in self.index:
+            return None
+        self.used.add((uuid, fingerprint))
+        if (uuid, fingerprint) in self.pending:
+            return str(self.pending[(uuid, fingerprint)])
+        row = self.conn.execute('SELECT data FROM thumbs WHERE uuid=? AND dimensions=? AND fingerprint=?',
+                                (uuid, self.dimensions, fingerprint)).fetchone()
+        return str(row[0]) if row else None
+
+    def put(self, uuid, fingerprint, data):
+        ''' Add a thumb, committed with the next batch '''
+        self.pending[(uuid, fingerprint)] = sqlite3.Binary(data)
+        self.index.add((uuid, fingerprint))
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.commit()
+
+    def touch(self, uuid):
+        ''' Mark the thumbs of a book's recorded cover as used '''
+        entry = self.covers.get(uuid)
+        if entry is not None:
+            self.used_covers.add(uuid)
+            self.used.add((uuid, entry[3]))
+
+    def get_cover_fingerprint(self, uuid, path, size, mtime):
+        ''' Return the recorded crc of an unchanged cover, or None '''
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        entry = self.covers.get(uuid)
+        if entry is None or entry[:3] != (path, size, mtime):
+            return None
+        if entry[4] - mtime < self.RACY_WINDOW:
+            return None
+        self.used_covers.add(uuid)
+        return entry[3]
+
+    def set_cover_fingerprint(self, uuid, path, size, mtime, fingerprint):
+        ''' Record the crc of a cover, committed with the next batch '''
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        entry = (path, size, mtime, fingerprint, time.time())
+        self.covers[uuid] = entry
+        self.pending_covers[uuid] = entry
+        if len(self.pending_covers) >= self.BATCH_SIZE:
+            self.commit()
+
+    def is_valid(self):
+        ''' Return True if a thumbnail pass for the dimensions completed '''
+        return self.conn.execute('SELECT 1 FROM meta WHERE name=?',
+                                 ('valid:' + self.dimensions,)).fetchone() is not None
+
+    def list_dimensions(self):
+        ''' Return the dimensions with valid thumbs '''
+        return sorted(row[0][len('valid:'):] for row in
+                      self.conn.execute("SELECT name FROM meta WHERE name LIKE 'valid:%'"))
+
+    def set_valid(self):
+        ''' Commit pending thumbs, validate store contents for the dimensions '''
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, '1')",
+                          ('valid:' + self.dimensions,))
+        self.commit()
+
+
+class CommentsCache(object):
+    '''
+    Persistent store of normalized comments, keyed by a digest of the raw
+    comments and the settings they were normalized with.
+
+    Each entry holds the description HTML and short description of a book.
+    Entries are looked up as books are fetched, new entries are committed in
+    batches of BATCH_SIZE. The store is emptied when opened with a different
+    version, as the normalized form depends on the plugin code. Each opening
+    of the store counts as a build, close() evicts entries not used in the
+    last MAX_AGE builds.
+    '''
+
+    BATCH_SIZE = 200
+    MAX_AGE = 5
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.pending = {}
+        self.used = set()
+        try:
+            self._open()
+        except sqlite3.DatabaseError:
+            # Unreadable store, start over
+            self.close()
+            os.remove(self.path)
+            self._open()
+
+    def _open(self):
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                          '(name TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS comments '
+                          '(key TEXT PRIMARY KEY, description TEXT, short_description TEXT, '
+                          'last_used INTEGER NOT NULL DEFAULT 0)')
+        row = self.conn.execute("SELECT value FROM meta WHERE name='version'").fetchone()
+        if row is None or row[0] != self.version:
+            self.conn.execute('DELETE FROM comments')
+            self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('version', ?)",
+                              (self.version,))
+        row = self.conn.execute("SELECT value FROM meta WHERE name='build'").fetchone()
+        self.build = (int(row[0]) if row is not None else 0) + 1
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('build', ?)",
+                          (str(self.build),))
+        self.conn.commit()
+
+    def close(self):
+        ''' Commit pending entries, evict stale entries, close the store '''
+        if getattr(self, 'conn', None) is not None:
+            try:
+                self.commit()
+                self.conn.execute('DELETE FROM comments WHERE last_used <= ?',
+                                  (self.build - self.MAX_AGE,))
+                self.conn.commit()
+            finally:
+                self.conn.close()
+                self.conn = None
+
+    def commit(self):
+        ''' Write pending entries and usage in a single transaction '''
+        if self.pending:
+            self.conn.executemany('INSERT OR REPLACE INTO comments '
+                                  '(key, description, short_description, last_used) '
+                                  'VALUES (?, ?, ?, ?)',
+                                  [(key,) + entry + (self.build,)
+                                   for (key, entry) in self.pending.iteritems()])
+            self.pending = {}
+        if self.used:
+            self.conn.executemany('UPDATE comments SET last_used=? WHERE key=?',
+                                  [(self.build, key) for key in self.used])
+            self.used = set()
+        self.conn.commit()
+
+    def get(self, key):
+        ''' Return (description, short_description), or None if not cached '''
+        if key in self.pending:
+            return self.pending[key]
+        row = self.conn.execute('SELECT description, short_description FROM comments WHERE key=?',
+                                (key,)).fetchone()
+        if row is None:
+            return None
+        self.used.add(key)
+        if len(self.used) >= self.BATCH_SIZE:
+            self.commit()
+        return tuple(row)
+
+    def put(self, key, description, short_description):
+        ''' Add an entry, committed with the next batch '''
+        self.pending[key] = (description, short_description)
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.commit()
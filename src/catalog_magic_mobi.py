@@ -85,6 +85,15 @@ class PluginWidget(QWidget,Ui_Form):
             opts_dict['output_profile'] = ['default']
         opts_dict['use_existing_cover'] = False
         opts_dict['thumb_width'] = 1.0
+        opts_dict['incremental_build'] = False
+        opts_dict['worker_count'] = 1
+        opts_dict['thumb_cache_age'] = 5
+        opts_dict['thumb_cache_size'] = 0
+        opts_dict['descriptions_per_file'] = 1
+        opts_dict['volume_split'] = ''
+        opts_dict['volume_size'] = 2000
+        opts_dict['volume_dir'] = None
+        opts_dict['volume_url'] = None
 
         if self.DEBUG:
             print "opts_dict"
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import with_statement
+
+__license__   = 'GPL v3'
+__copyright__ = '2013, yosssoy <yossoy@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import re
+
+from calibre.utils.filenames import ascii_text
+
+
+def author_anchor(author):
+    ''' Legal XHTML anchor of an author name '''
+    return re.sub("\W", "", ascii_text(author))
+
+
+def _series_idx(book):
+    series_index = str(book['series_index'])
+    if series_index.endswith('.0'):
+        series_index = series_index[:-2]
+    return series_index
+
+
+def _url(book):
+    if 'description_file' in book:
+        # Description packed with others, see assign_description_files()
+        return "%s#book%d" % (book['description_file'], int(float(book['id'])))
+    return "book_%d.html" % (int(float(book['id'])))
+
+
+# Fields computed from the record when read, never stored
+DERIVED_FIELDS = {
+    'author_url': lambda book: "ByAuthor.html#%s" % author_anchor(book['author']),
+    'genres': lambda book: book['tags'],
+    'pubyear': lambda book: book['date'].split()[1] if book['date'] else None,
+    'series_idx': _series_idx,
+    'url': _url,
+    }
+
+
+class CatalogBook(object):
+    '''
+    Book record of the catalog.
+
+    Slotted replacement of the per-book dict, with mapping access so it
+    reads and writes like one. Unset fields are missing keys. The fields in
+    DERIVED_FIELDS are computed when read, section pages list the records
+    themselves instead of copies carrying those fields.
+    '''
+
+    __slots__ = ('author', 'author_sort', 'authors', 'cover', 'date',
+                 'description', 'description_file', 'fingerprint', 'formats', 'id', 'languages',
+                 'publisher', 'rating', 'series', 'series_index',
+                 'series_sort_key', 'short_description', 'sort_author',
+                 'sort_series', 'sort_series_index', 'sort_title', 'tags',
+                 'timestamp', 'title', 'title_sort', 'title_sort_key', 'uuid')
+
+    FIELDS = frozenset(__slots__)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, key):
+        if key in DERIVED_FIELDS:
+            return DERIVED_FIELDS[key](self)
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        ''' dict.get() '''
+        if key in self:
+            return self[key]
+        return default
+
+    def has_key(self, key):
+        ''' dict.has_key() '''
+        return key in self
+
+    def keys(self):
+        ''' Set fields, then derived fields '''
+        return [key for key in self.__slots__ if hasattr(self, key)] + sorted(DERIVED_FIELDS)
+
+
+class BookView(object):
+    '''
+    Book record as listed in a section with some fields replaced.
+
+    Reads fall through to the shared book record, except for the fields
+    given as overrides and the DERIVED_FIELDS, which are computed from the
+    view. Writes go to the overrides, the shared record is never modified
+    through a view.
+    '''
+
+    __slots__ = ('book', 'overrides')
+
+    def __init__(self, book, **overrides):
+        self.book = book
+        self.overrides = overrides
+
+    def __contains__(self, key):
+        return key in self.overrides or key in self.book
+
+    def __getitem__(self, key):
+        if key in self.overrides:
+            return self.overrides[key]
+        if key in DERIVED_FIELDS:
+            # Derived from the view's fields, e.g. author_url
+            return DERIVED_FIELDS[key](self)
+        return self.book[key]
+
+    def __setitem__(self, key, value):
+        self.overrides[key] = value
+
+    def get(self, key, default=None):
+        ''' dict.get() '''
+        if key in self:
+            return self[key]
+        return default
+
+    def has_key(self, key):
+        ''' dict.has_key() '''
+        return key in self
+
+    def keys(self):
+        ''' Keys of the book record and the overrides '''
+        return list(set(self.book.keys()) | set(self.overrides))
+
+
+class AuthorView(BookView):
+    '''
+    Book record as listed under one of its additional authors, with author,
+    authors, author_sort and sort_author overridden.
+    '''
+
+    __slots__ = ()
+
+
+class SeriesView(BookView):
+    '''
+    Book record as listed on the Series page, series_index reads as the
+    display string series templates print, e.g. '1' for 1.0.
+    '''
+
+    __slots__ = ()
+
+    def __init__(self, book):
+        BookView.__init__(self, book, series_index=_series_idx(book))
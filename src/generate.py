@@ -3,8 +3,8 @@
 __license__ = 'GPL v3'
 __copyright__ = '2010, Greg Riker'
 
-import datetime, htmlentitydefs, os, platform, re, shutil, unicodedata, zlib
-from copy import deepcopy
+import datetime, hashlib, htmlentitydefs, json, os, platform, re, shutil, unicodedata, zlib
+from lxml import etree
 from xml.sax.saxutils import escape
 from calibre import config_dir
 
@@ -16,6 +16,7 @@ from calibre.customize.ui import output_profiles
 from calibre.ebooks.BeautifulSoup import BeautifulSoup, BeautifulStoneSoup, Tag, NavigableString
 from calibre.ebooks.chardet import substitute_entites
 from calibre.ebooks.metadata import author_to_author_sort
+from calibre.ebooks.oeb.base import XHTML_NS
 from calibre.library.catalogs import AuthorSortMismatchException, EmptyCatalogException, \
                                      InvalidGenresSourceFieldException
 from calibre.ptempfile import PersistentTemporaryDirectory
@@ -23,12 +24,57 @@ from calibre.utils.date import format_date, is_date_undefined, now as nowf
 from calibre.utils.filenames import ascii_text, shorten_components_to
 from calibre.utils.icu import capitalize, collation_order, sort_key
 from calibre.utils.magick.draw import thumbnail
-from calibre.utils.zipfile import ZipFile
 from calibre.utils.localization import langnames_to_langcodes, get_language, get_lang, lang_as_iso639_1
+from calibre.utils.lock import ExclusiveFile, LockError
 from urllib import pathname2url, quote
 from templite import Templite
 from calibre_plugins.magic_mobi.catalog_magic_mobi import parse_library_url
+from calibre_plugins.magic_mobi.catalog_cache import CommentsCache, ThumbnailCache
+from calibre_plugins.magic_mobi.catalog_records import AuthorView, CatalogBook, SeriesView, author_anchor
+from calibre_plugins.magic_mobi.writers import XMLWriter
 from urlparse import urljoin
+from multiprocessing import Pool
+from threading import Thread
+
+def book_fingerprint(record):
+    ''' Digest of the metadata fields and cover file a book is rendered from '''
+    values = []
+    for field in ['id', 'uuid', 'title', 'series', 'series_index', 'authors',
+                  'author_sort', 'publisher', 'rating', 'pubdate', 'timestamp',
+                  'comments', 'cover', 'tags', 'languages', 'formats']:
+        value = record.get(field)
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        values.append(value)
+    if record.get('cover') and os.path.exists(record['cover']):
+        st = os.stat(record['cover'])
+        values.append((st.st_size, st.st_mtime))
+    return hashlib.md5(repr(values)).hexdigest()
+
+# Builder inherited by forked description rendering workers
+_worker_builder = None
+
+def _render_html_descriptions(chunk):
+    ''' Render a chunk of description_files in a worker process '''
+    rendered = []
+    for file_num in chunk:
+        (file_name, item_id, books) = _worker_builder.description_files[file_num]
+        rendered.append((file_name, len(books),
+                         _worker_builder.generate_html_description_file(books)))
+    return rendered
+
+def _render_thumbnails(chunk):
+    ''' Read and resize a chunk of covers in a worker process '''
+    rendered = []
+    for title_num in chunk:
+        try:
+            cover_crc, cover_stat, thumb_data = _worker_builder.render_thumbnail(
+                _worker_builder.books_by_title[title_num])
+        except:
+            cover_crc = cover_stat = thumb_data = None
+        rendered.append((title_num, cover_crc, cover_stat, thumb_data))
+    return rendered
+
 class CatalogBuilder(object):
     '''
     Generates catalog source files from calibre database
@@ -46,6 +92,39 @@ class CatalogBuilder(object):
 
     DEBUG = False
 
+    # Bump to invalidate manifests written by older incremental builds
+    BUILD_MANIFEST_VERSION = 1
+
+    # Seconds to wait for a catalog job of the same library to release the cache
+    CACHE_LOCK_TIMEOUT = 15
+
+    # Formatted NCX author lines kept by format_ncx_text()
+    NCX_TEXT_CACHE_SIZE = 4096
+
+    # Books per chunk handed to a description rendering worker
+    RENDER_CHUNK_SIZE = 50
+
+    # Markup tokenize_comments() writes as BeautifulSoup does, grouped by
+    # BeautifulSoup nesting rules. Other tags may only nest in a tag of
+    # another name, <li> only in <ol> or <ul>, <p> only at top level or in
+    # a block that resets nesting.
+    COMMENT_NESTABLE_TAGS = frozenset(['blockquote', 'div', 'font', 'ol', 'span',
+                                       'sub', 'sup', 'ul'])
+    COMMENT_RESET_NESTING_TAGS = frozenset(['blockquote', 'div', 'li', 'ol', 'ul'])
+    COMMENT_VOID_TAGS = frozenset(['br', 'hr', 'img'])
+    COMMENT_TAGS = COMMENT_NESTABLE_TAGS | COMMENT_VOID_TAGS | frozenset(
+        ['a', 'b', 'big', 'cite', 'code', 'em', 'i', 'li', 'p', 's', 'small',
+         'strike', 'strong', 'u'])
+    COMMENT_TAG = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)'
+                             r'((?:\s+[a-zA-Z_][-:.a-zA-Z_0-9]*\s*=\s*(?:"[^"]*"|\'[^\']*\'))*)'
+                             r'\s*(/?)>$')
+
+    # Stylesheet and templates, preloaded into the resource cache
+    PAGE_RESOURCES = ['magic_catalog/magic_stylesheet.css',
+                      'magic_catalog/magic_template.xhtml',
+                      'magic_catalog/magic_author_template.xhtml',
+                      'magic_catalog/magic_series_template.xhtml']
+
     # A single number creates 'Last x days' only.
     # Multiple numbers create 'Last x days', 'x to y days ago' ...
     # e.g, [7,15,30,60] or [30]
@@ -94,7 +173,8 @@ class CatalogBuilder(object):
     def __init__(self, db, _opts, plugin,
                     report_progress=DummyReporter(),
                     stylesheet="content/magic_stylesheet.css",
-                    init_resources=True):
+                    init_resources=True,
+                    fetch_only=False):
 
         self.db = db
         self.opts = _opts
@@ -104,47 +184,90 @@ class CatalogBuilder(object):
         self.plugin = plugin
         self.reporter = report_progress
         self.stylesheet = stylesheet
-        self.cache_dir = os.path.join(cache_dir(), 'catalog')
-        self.catalog_path = PersistentTemporaryDirectory("_magic_mobi_catalog", prefix='')
-        self.content_dir = os.path.join(self.catalog_path, "content")
-        self.excluded_tags = self.get_excluded_tags()
-
-        self.all_series = set()
-        self.authors = None
-        self.books_by_author = None
-        self.books_by_date_range = None
-        self.books_by_description = []
-        self.books_by_month = None
-        self.books_by_series = None
-        self.books_by_title = None
-        self.books_by_title_no_series_prefix = None
-        self.books_to_catalog = None
-        self.current_step = 0.0
-        self.error = []
-        self.genres = []
-        self.genre_tags_dict = self.filter_genre_tags(max_len=245 - len("%s/Genre_.html" % self.content_dir)) # @@@
-        self.html_filelist_1 = []
-        self.html_filelist_2 = []
-        self.individual_authors = None
-        self.ncx_soup = None
-        self.output_profile = self.get_output_profile(_opts)
-        self.play_order = 1
-        self.progress_int = 0.0
-        self.progress_string = ''
-        self.thumb_height = 0
-        self.thumb_width = 0
-        self.thumbs = None
-        self.thumbs_path = os.path.join(self.cache_dir, "thumbs.zip")
-        self.total_steps = 6.0
-        self.use_series_prefix_in_titles_section = False
-
-        self.dump_custom_fields()
-        self.books_to_catalog = self.fetch_books_to_catalog()
-        self.compute_total_steps()
-        self.calculate_thumbnail_dimensions()
-        self.confirm_thumbs_archive()
-        if init_resources:
-            self.copy_catalog_resources()
+        self.cache_lock = None
+        self.cache_dir = self.lock_cache_dir()
+        try:
+            self.incremental = bool(self.opts.incremental_build) and self.cache_lock is not None
+            if self.incremental:
+                # Sources persist between builds, keyed by library, output profile
+                # and volume
+                self.catalog_path = os.path.join(self.cache_dir, 'builds',
+                                                 self.opts.output_profile)
+                if getattr(self.opts, 'volume', None):
+                    self.catalog_path = os.path.join(self.catalog_path, 'volumes', self.opts.volume)
+            else:
+                self.catalog_path = PersistentTemporaryDirectory("_magic_mobi_catalog", prefix='')
+            self.content_dir = os.path.join(self.catalog_path, "content")
+            self.excluded_tags = self.get_excluded_tags()
+
+            self.all_series = set()
+            self.authors = None
+            self.books_by_author = None
+            self.books_by_date_range = None
+            self.books_by_description = []
+            self.books_by_month = None
+            self.books_by_series = None
+            self.books_by_title = None
+            self.books_by_title_no_series_prefix = None
+            self.books_to_catalog = None
+            self.build_manifest = None
+            self.cached_output = None
+            self.catalog_data = None
+            self.changed_book_ids = set()
+            self.comments_cache = None
+            self.compiled_templates = {}
+            self.current_step = 0.0
+            self.description_files = []
+            self.error = []
+            self.friendly_genre_tags = {}
+            self.genres = []
+            self.genre_tags_dict = self.filter_genre_tags(max_len=245 - len("%s/Genre_.html" % self.content_dir)) # @@@
+            self.genre_tag_index = {}
+            self.html_filelist_1 = []
+            self.html_filelist_2 = []
+            self.individual_authors = None
+            self.ncx_output_escaping = None
+            self.ncx_text_cache = {}
+            self.ncx_writer = None
+            self.output_fingerprint = None
+            self.output_profile = self.get_output_profile(_opts)
+            self.play_order = 1
+            self.previous_manifest = None
+            self.progress_int = 0.0
+            self.progress_string = ''
+            self.resource_cache = {}
+            self.series_sort_titles = {}
+            self.thumb_height = 0
+            self.thumb_width = 0
+            self.thumbs = None
+            self.thumbs_cache = None
+            self.thumbs_compaction = None
+            self.thumbs_path = os.path.join(self.cache_dir, "thumbs.db")
+            self.total_steps = 6.0
+            self.use_series_prefix_in_titles_section = False
+
+            self.dump_custom_fields()
+            data = self.fetch_catalog_data()
+            if fetch_only:
+                # Books to catalog only, partitioned by VolumeBuilder
+                self.catalog_data = data
+                return
+            self.output_fingerprint = self.generate_output_fingerprint(data)
+            self.cached_output = self.get_cached_output()
+            if self.cached_output is not None:
+                # Nothing to build, the previous output is reused
+                return
+            self.books_to_catalog = self.fetch_books_to_catalog(data)
+            self.load_build_manifest()
+            self.compute_total_steps()
+            self.calculate_thumbnail_dimensions()
+            self.confirm_thumbs_archive()
+            if init_resources:
+                self.copy_catalog_resources()
+        except:
+            # run() has no builder to release the lock through
+            self.release_cache_dir()
+            raise
 
     """ key() functions """
 
@@ -182,15 +305,11 @@ class CatalogBuilder(object):
         """
         if not book['series']:
             key = '%s %s' % (self._kf_author_to_author_sort(book['author']),
-                                capitalize(book['title_sort']))
+                                book['sort_title'])
         else:
-            index = book['series_index']
-            integer = int(index)
-            fraction = index - integer
-            series_index = '%04d%s' % (integer, str('%0.4f' % fraction).lstrip('0'))
             key = '%s ~%s %s' % (self._kf_author_to_author_sort(book['author']),
-                                    self.generate_sort_title(book['series']),
-                                    series_index)
+                                    book['sort_series'],
+                                    book['sort_series_index'])
         return key
 
     def _kf_books_by_author_sorter_author_sort(self, book, longest_author_sort=60):
@@ -207,30 +326,52 @@ class CatalogBuilder(object):
         """
         if not book['series']:
             fs = u'{:<%d}!{!s}' % longest_author_sort
-            key = fs.format(capitalize(book['author_sort']),
-                            capitalize(book['title_sort']))
+            key = fs.format(book['sort_author'],
+                            book['sort_title'])
         else:
-            index = book['series_index']
-            integer = int(index)
-            fraction = index - integer
-            series_index = u'%04d%s' % (integer, str(u'%0.4f' % fraction).lstrip(u'0'))
             fs = u'{:<%d}~{!s}{!s}' % longest_author_sort
-            key = fs.format(capitalize(book['author_sort']),
-                            self.generate_sort_title(book['series']),
-                            series_index)
+            key = fs.format(book['sort_author'],
+                            book['sort_series'],
+                            book['sort_series_index'])
         return key
 
     def _kf_books_by_series_sorter(self, book):
-        index = book['series_index']
-        integer = int(index)
-        fraction = index - integer
-        series_index = '%04d%s' % (integer, str('%0.4f' % fraction).lstrip('0'))
-        key = '%s %s' % (self.generate_sort_title(book['series']),
-                         series_index)
+        key = '%s %s' % (book['sort_series'],
+                         book['sort_series_index'])
         return key
 
     """ Methods """
 
+    def assign_description_files(self):
+        """ Distribute Descriptions over content files.
+
+        Books are packed opts.descriptions_per_file per file, in
+        books_by_description order. With one Description per file the files
+        are named by book, book_<id>.html, otherwise descriptions_<n>.html,
+        and each book records its file, see CatalogBook's url.
+
+        Inputs:
+         books_by_description (list)
+
+        Outputs:
+         description_files (list): [(file name, OPF item id, [books])]
+        """
+        per_file = self.opts.descriptions_per_file
+        self.description_files = []
+        if per_file <= 1:
+            for book in self.books_by_description:
+                self.description_files.append(("book_%d.html" % int(book['id']),
+                                               "book%d" % int(book['id']),
+                                               [book]))
+            return
+
+        for (i, start) in enumerate(range(0, len(self.books_by_description), per_file)):
+            file_name = "descriptions_%d.html" % (i + 1)
+            books = self.books_by_description[start:start + per_file]
+            for book in books:
+                book['description_file'] = file_name
+            self.description_files.append((file_name, "descriptions%d" % (i + 1), books))
+
     def build_sources(self):
         """ Generate catalog source files.
 
@@ -253,17 +394,29 @@ class CatalogBuilder(object):
         self.fetch_books_by_author()
         self.generate_thumbnails()
         self.generate_html_descriptions()
-        self.generate_html_by_author()
-        self.generate_html_by_series()
-        self.generate_html_by_genres()
-        self.generate_opf()
-        self.generate_ncx_header()
-        self.generate_ncx_by_author(_("Authors"))
-        self.generate_ncx_descriptions(_("Descriptions"))
-        if self.opts.generate_series:
-            self.generate_ncx_by_series(_("Series"))
-        self.generate_ncx_by_genre(_("Genres"))
-        self.write_ncx()
+        # Evict stale thumbs off the critical path. Started once the
+        # description workers have been forked, a fork must not copy the
+        # locks held by the compaction thread.
+        self.thumbs_compaction = Thread(target=self.compact_thumbs_cache)
+        self.thumbs_compaction.start()
+        try:
+            self.generate_html_by_author()
+            self.generate_html_by_series()
+            self.generate_html_by_genres()
+            self.generate_opf()
+            self.generate_ncx_header()
+            self.generate_ncx_by_author(_("Authors"))
+            self.generate_ncx_descriptions(_("Descriptions"))
+            if self.opts.generate_series:
+                self.generate_ncx_by_series(_("Series"))
+            self.generate_ncx_by_genre(_("Genres"))
+            self.write_ncx()
+            if self.incremental:
+                self.remove_stale_sources()
+                self.save_build_manifest()
+        finally:
+            # The store must not be compacted once the cache lock is released
+            self.thumbs_compaction.join()
 
     def calculate_thumbnail_dimensions(self):
         """ Calculate thumb dimensions based on device DPI.
@@ -292,6 +445,30 @@ class CatalogBuilder(object):
             self.opts.log("  DPI = %d; thumbnail dimensions: %d x %d" % \
                             (x.dpi, self.thumb_width, self.thumb_height))
 
+    def compact_thumbs_cache(self):
+        """ Evict stale thumbs from the thumbs store.
+
+        Runs in a background thread started by build_sources() after the
+        Descriptions section, while the remaining sections are generated.
+        Thumbs not used for opts.thumb_cache_age builds are evicted, then
+        least recently used thumbs while the store exceeds
+        opts.thumb_cache_size.
+
+        Inputs:
+         thumbs_cache (ThumbnailCache): closed thumbs store
+
+        Outputs:
+         (file): compacted thumbs store
+        """
+        try:
+            evicted = self.thumbs_cache.compact(self.opts.thumb_cache_age,
+                                                self.opts.thumb_cache_size * 1024 * 1024)
+            if evicted and self.opts.verbose:
+                self.opts.log.info("  evicted %d thumbs from cache at %s" % (evicted, self.thumbs_path))
+        except:
+            # A failed compaction leaves the store as it was
+            self.opts.log.warn("  unable to compact thumb cache at %s" % self.thumbs_path)
+
     def compute_total_steps(self):
         """ Calculate number of build steps to generate catalog.
 
@@ -312,49 +489,44 @@ class CatalogBuilder(object):
         self.total_steps += incremental_jobs
 
     def confirm_thumbs_archive(self):
-        """ Validate thumbs archive.
+        """ Validate thumbs store.
 
-        Confirm existence of thumbs archive, or create if absent.
-        Confirm stored thumb_width matches current opts.thumb_width,
-        or invalidate archive.
-        generate_thumbnails() writes current thumb_width to archive.
+        Open thumbs store, or create if absent.
+        The store keeps thumbs of each thumb size side by side. Confirm
+        thumbs of the current thumb dimensions were validated by a complete
+        build, or invalidate them.
+        generate_thumbnails() validates thumbs of the current dimensions.
 
         Inputs:
-         opts.thumb_width (float): requested thumb_width
-         thumbs_path (file): existing thumbs archive
+         thumb_width, thumb_height (float): calculated thumb dimensions
+         thumbs_path (file): existing thumbs store
 
         Outputs:
-         thumbs_path (file): new (non_existent or invalidated), or
-                                  validated existing thumbs archive
+         thumbs_cache (ThumbnailCache): new (non_existent or invalidated), or
+                                        validated existing thumbs store
         """
         if not os.path.exists(self.cache_dir):
             self.opts.log.info("  creating new thumb cache '%s'" % self.cache_dir)
             os.makedirs(self.cache_dir)
-        if not os.path.exists(self.thumbs_path):
-            self.opts.log.info('  creating thumbnail archive, thumb_width: %1.2f"' %
-                               float(self.opts.thumb_width))
-            with ZipFile(self.thumbs_path, mode='w') as zfw:
-                zfw.writestr("Catalog Thumbs Archive", '')
-        else:
-            try:
-                with ZipFile(self.thumbs_path, mode='r') as zfr:
-                    try:
-                        cached_thumb_width = zfr.read('thumb_width')
-                    except:
-                        cached_thumb_width = "-1"
-            except:
-                os.remove(self.thumbs_path)
-                cached_thumb_width = '-1'
-
-            if float(cached_thumb_width) != float(self.opts.thumb_width):
-                self.opts.log.warning("  invalidating cache at '%s'" % self.thumbs_path)
-                self.opts.log.warning('  thumb_width changed: %1.2f" => %1.2f"' %
-                                      (float(cached_thumb_width), float(self.opts.thumb_width)))
-                with ZipFile(self.thumbs_path, mode='w') as zfw:
-                    zfw.writestr("Catalog Thumbs Archive", '')
+
+        dimensions = "%dx%d" % (self.thumb_width, self.thumb_height)
+        existing = os.path.exists(self.thumbs_path)
+        self.thumbs_cache = ThumbnailCache(self.thumbs_path, dimensions)
+        if not existing:
+            self.opts.log.info('  creating thumbnail store, thumb_width: %1.2f" (%s)' %
+                               (float(self.opts.thumb_width), dimensions))
+        elif not self.thumbs_cache.is_valid():
+            if len(self.thumbs_cache):
+                self.opts.log.warning("  invalidating %s thumbs in cache at '%s'" %
+                                      (dimensions, self.thumbs_path))
+                self.thumbs_cache.clear()
             else:
-                self.opts.log.info('  existing thumb cache at %s, cached_thumb_width: %1.2f"' %
-                                   (self.thumbs_path, float(cached_thumb_width)))
+                self.opts.log.info('  existing thumb cache at %s, no %s thumbs, cached dimensions: %s' %
+                                   (self.thumbs_path, dimensions,
+                                    ', '.join(self.thumbs_cache.list_dimensions()) or 'none'))
+        else:
+            self.opts.log.info('  existing thumb cache at %s, %d %s thumbs' %
+                               (self.thumbs_path, len(self.thumbs_cache), dimensions))
 
     def convert_html_entities(self, s):
         """ Convert string containing HTML entities to its unicode equivalent.
@@ -397,6 +569,8 @@ class CatalogBuilder(object):
         Copy basic resources - default cover, stylesheet, and masthead (Kindle only)
         from calibre resource directory to self.catalog_path, a temporary directory
         for constructing the catalog. Files stored to specified destination dirs.
+        Stylesheet and templates are preloaded into the resource cache, from the
+        same extraction of the plugin zip.
 
         Inputs:
          files_to_copy (files): resource files from calibre resources, which may be overridden locally
@@ -413,7 +587,11 @@ class CatalogBuilder(object):
         files_to_copy.extend([('images', 'mastheadImage.gif')])
 
         files = ['magic_catalog/' + file[1] for file in files_to_copy]
+        files.extend([name for name in self.PAGE_RESOURCES if name not in files])
         arcfiles = self.plugin.load_resources(files)
+        for name in self.PAGE_RESOURCES:
+            if not os.path.exists(os.path.join(config_dir, 'resources', name)):
+                self.resource_cache[name] = (None, arcfiles[name])
 
         self.opts.log.info("create catalog directory (userpath=\"%s\"" % user_path)
         for file in files_to_copy:
@@ -454,6 +632,64 @@ class CatalogBuilder(object):
         if not os.path.isdir(images_path):
             os.makedirs(images_path)
 
+    def decode_ncx_text(self, description):
+        """ Convert entities of NCX text without parsing.
+
+        Equivalent of unicode(BeautifulStoneSoup(description,
+        convertEntities=BeautifulStoneSoup.HTML_ENTITIES)) for text without
+        markup whose entities are all known HTML entities or decimal character
+        references. How BeautifulStoneSoup escapes its output is probed once,
+        the conversion is disabled if the probe is not reproduced.
+
+        Args:
+         description (str): string, possibly with HTML entities
+
+        Return:
+         (unicode): converted string, or None if description must be parsed
+        """
+
+        def _decode(description, escaping):
+            unconverted = []
+
+            def _convert(match):
+                if match.group(1):
+                    code = int(match.group(1))
+                    if 0 < code < 0x80 or 0x9f < code < 0xd800:
+                        return unichr(code)
+                elif match.group(2) in htmlentitydefs.name2codepoint:
+                    return unichr(htmlentitydefs.name2codepoint[match.group(2)])
+                unconverted.append(match.group(0))
+                return match.group(0)
+
+            decoded = re.sub(r'&(?:#([0-9]{1,5})|([a-zA-Z][a-zA-Z0-9]*));|&', _convert, description)
+            if unconverted:
+                return None
+            if escaping == 'bare':
+                # Bare ampersands and brackets escaped on output
+                decoded = re.sub(r'([<>]|&(?!#\d+;|#x[0-9a-fA-F]+;|\w+;))',
+                                 lambda m: {'&': '&amp;', '<': '&lt;', '>': '&gt;'}[m.group(0)],
+                                 decoded)
+            return decoded
+
+        if self.ncx_output_escaping is None:
+            probe = u'&amp;&gt;&lt;&quot;&#65;&amp;amp;&middot; > x'
+            rendered = unicode(BeautifulStoneSoup(probe, convertEntities=BeautifulStoneSoup.HTML_ENTITIES))
+            self.ncx_output_escaping = False
+            for escaping in ['none', 'bare']:
+                if _decode(probe, escaping) == rendered:
+                    self.ncx_output_escaping = escaping
+                    break
+
+        if (not self.ncx_output_escaping or not isinstance(description, basestring) or
+                '<' in description):
+            return None
+        if isinstance(description, str):
+            try:
+                description = description.decode('ascii')
+            except UnicodeDecodeError:
+                return None
+        return _decode(description, self.ncx_output_escaping)
+
     def detect_author_sort_mismatches(self, books_to_test):
         """ Detect author_sort mismatches.
 
@@ -627,11 +863,13 @@ class CatalogBuilder(object):
         asl = [i['author_sort'] for i in books_by_author]
         las = max(asl, key=len)
 
+        # Collation keys computed once, books_by_description shares the records
+        author_sort_keys = dict((id(book), sort_key(self._kf_books_by_author_sorter_author_sort(book, len(las))))
+                                for book in books_by_author)
         self.books_by_description = sorted(books_by_description,
-                                           key=lambda x: sort_key(self._kf_books_by_author_sorter_author_sort(x, len(las))))
+                                           key=lambda x: author_sort_keys[id(x)])
 
-        books_by_author = sorted(books_by_author,
-            key=lambda x: sort_key(self._kf_books_by_author_sorter_author_sort(x, len(las))))
+        books_by_author = sorted(books_by_author, key=lambda x: author_sort_keys[id(x)])
 
         if self.DEBUG and self.opts.verbose:
             tl = [i['title'] for i in books_by_author]
@@ -676,6 +914,7 @@ class CatalogBuilder(object):
 
         self.authors = list(unique_authors)
         self.books_by_author = books_by_author
+        self.assign_description_files()
 
         for ua in unique_authors:
             for ia in ua[0].replace(' &amp; ', ' & ').split(' & '):
@@ -711,7 +950,7 @@ class CatalogBuilder(object):
         self.update_progress_full_step(_("Sorting titles"))
         # Re-sort based on title_sort
         if len(self.books_to_catalog):
-            self.books_by_title = sorted(self.books_to_catalog, key=lambda x: sort_key(x['title_sort'].upper()))
+            self.books_by_title = sorted(self.books_to_catalog, key=lambda x: x['title_sort_key'])
 
             if self.DEBUG and self.opts.verbose:
                 self.opts.log.info("fetch_books_by_title(): %d books" % len(self.books_by_title))
@@ -726,7 +965,7 @@ class CatalogBuilder(object):
             self.error.append(error_msg)
             raise EmptyCatalogException, error_msg
 
-    def fetch_books_to_catalog(self):
+    def fetch_books_to_catalog(self, data):
         """ Populate self.books_to_catalog from database
 
         Create self.books_to_catalog from filtered database.
@@ -749,11 +988,12 @@ class CatalogBuilder(object):
          title_sort         computed from record['title']
          uuid               record['uuid']
 
-        Inputs:
+        Args:
          data (list): filtered list of book metadata dicts
 
         Outputs:
          (list) books_to_catalog
+         genre_tag_index (dict): genre tag: [book ids]
 
         Returns:
          True: Successful
@@ -762,10 +1002,12 @@ class CatalogBuilder(object):
 
         def _populate_title(record):
             ''' populate this_title with massaged metadata '''
-            this_title = {}
+            this_title = CatalogBook()
 
             this_title['id'] = record['id']
             this_title['uuid'] = record['uuid']
+            # Computed with the output fingerprint
+            this_title['fingerprint'] = record['fingerprint']
 
             this_title['title'] = self.convert_html_entities(record['title'])
             if record['series']:
@@ -813,16 +1055,18 @@ class CatalogBuilder(object):
                 if ad_offset >= 0:
                     record['comments'] = record['comments'][:ad_offset]
 
-                this_title['description'] = self.massage_comments(record['comments'])
-
-                # Create short description
-                paras = BeautifulSoup(this_title['description']).findAll('p')
-                tokens = []
-                for p in paras:
-                    for token in p.contents:
-                        if token.string is not None:
-                            tokens.append(token.string)
-                this_title['short_description'] = self.generate_short_description(' '.join(tokens), dest="description")
+                # Normalized comments are cached by comments and clip setting
+                comments_key = hashlib.md5(repr((record['comments'],
+                                                 self.opts.description_clip))).hexdigest()
+                cached = self.comments_cache.get(comments_key)
+                if cached is None:
+                    description, description_text = self.normalize_comments(record['comments'])
+
+                    # Create short description
+                    cached = (description,
+                              self.generate_short_description(description_text, dest="description"))
+                    self.comments_cache.put(comments_key, *cached)
+                this_title['description'], this_title['short_description'] = cached
             else:
                 this_title['description'] = None
                 this_title['short_description'] = None
@@ -832,10 +1076,10 @@ class CatalogBuilder(object):
             if record['cover']:
                 this_title['cover'] = re.sub('&amp;', '&', record['cover'])
 
+            # genres is derived, same list as tags
             this_title['tags'] = []
             if record['tags']:
                 this_title['tags'] = map(self.convert_html_entities, record['tags'])
-            this_title['genres'] = this_title['tags']
 
             this_title['languages'] = "en"
             if record['languages']:
@@ -847,10 +1091,38 @@ class CatalogBuilder(object):
                     formats.append(self.convert_html_entities(format))
                 this_title['formats'] = formats
 
+            self.generate_sort_keys(this_title)
+
             return this_title
 
         # Entry point
 
+        # Populate this_title{} from data[{},{}], index books by genre tag
+        self.comments_cache = CommentsCache(os.path.join(self.cache_dir, "comments.db"),
+                                            '.'.join(map(str, self.plugin.version)))
+        titles = []
+        try:
+            for record in data:
+                this_title = _populate_title(record)
+                titles.append(this_title)
+                for tag in this_title['genres']:
+                    if tag in self.genre_tags_dict:
+                        self.genre_tag_index.setdefault(tag, []).append(this_title['id'])
+        finally:
+            self.comments_cache.close()
+        return titles
+
+    def fetch_catalog_data(self):
+        """ Fetch the metadata of the books to catalog from the database.
+
+        Excluded tags are added to the search, restricted to opts.ids if given.
+
+        Inputs:
+         excluded_tags (list): tags excluding books from the catalog
+
+        Return:
+         (list): book metadata dicts, sorted by title
+        """
         self.opts.sort_by = 'title'
         search_phrase = ''
         if self.excluded_tags:
@@ -869,14 +1141,7 @@ class CatalogBuilder(object):
                 self.opts.search_text = search_phrase
 
         # Fetch the database as a dictionary
-        data = self.plugin.search_sort_db(self.db, self.opts)
-
-        # Populate this_title{} from data[{},{}]
-        titles = []
-        for record in data:
-            this_title = _populate_title(record)
-            titles.append(this_title)
-        return titles
+        return self.plugin.search_sort_db(self.db, self.opts)
 
     def filter_genre_tags(self, max_len):
         """ Remove excluded tags from data set, return normalized genre list.
@@ -888,6 +1153,9 @@ class CatalogBuilder(object):
         Args:
          max_len: maximum length of normalized tag to fit within OS constraints
 
+        Updated:
+         friendly_genre_tags (dict): normalized tag to first friendly tag
+
         Return:
          genre_tags_dict (dict): dict of filtered, normalized tags in data set
         """
@@ -958,14 +1226,19 @@ class CatalogBuilder(object):
 
         genre_tags_dict = dict(zip(friendly_tags, normalized_tags))
 
+        # Reverse index, friendly tags listed in genre_tags_dict order
+        tags_by_normalized = {}
+        for friendly_tag, normalized in genre_tags_dict.iteritems():
+            tags_by_normalized.setdefault(normalized, []).append(friendly_tag)
+        self.friendly_genre_tags = dict((normalized, tags[0])
+                                        for normalized, tags in tags_by_normalized.iteritems())
+
         # Test for multiple genres resolving to same normalized form
-        normalized_set = set(normalized_tags)
-        for normalized in normalized_set:
-            if normalized_tags.count(normalized) > 1:
+        for normalized, tags in tags_by_normalized.iteritems():
+            if len(tags) > 1:
                 self.opts.log.warn("      Warning: multiple tags resolving to genre '%s':" % normalized)
-                for key in genre_tags_dict:
-                    if genre_tags_dict[key] == normalized:
-                        self.opts.log.warn("       %s" % key)
+                for key in tags:
+                    self.opts.log.warn("       %s" % key)
         if self.opts.verbose:
             self.opts.log.info('%s' % _format_tag_list(genre_tags_dict, header="enabled genres"))
             self.opts.log.info('%s' % _format_tag_list(excluded_tags, header="excluded genres"))
@@ -979,6 +1252,10 @@ class CatalogBuilder(object):
         Convert HTML entities for proper display on Kindle, convert
         '&amp;' to '&#38;' (Kindle fails).
 
+        Author lines repeat across books and are memoized, up to
+        NCX_TEXT_CACHE_SIZE of them. Titles and descriptions are unique,
+        they are not.
+
         Args:
          description (str): string, possibly with HTM entities
          dest (kwarg): author, title or description
@@ -986,18 +1263,29 @@ class CatalogBuilder(object):
         Return:
          (str): massaged, possibly truncated description
         """
+        memoize = dest == 'author' and type(description) in (str, unicode)
+        if memoize and (description, dest) in self.ncx_text_cache:
+            return self.ncx_text_cache[(description, dest)]
+
         # Kindle TOC descriptions won't render certain characters
         # Fix up
-        massaged = unicode(BeautifulStoneSoup(description, convertEntities=BeautifulStoneSoup.HTML_ENTITIES))
+        massaged = self.decode_ncx_text(description)
+        if massaged is None:
+            massaged = unicode(BeautifulStoneSoup(description, convertEntities=BeautifulStoneSoup.HTML_ENTITIES))
 
         # Replace '&' with '&#38;'
         massaged = re.sub("&", "&#38;", massaged)
 
         if massaged.strip() and dest:
             #print traceback.print_stack(limit=3)
-            return self.generate_short_description(massaged.strip(), dest=dest)
+            massaged = self.generate_short_description(massaged.strip(), dest=dest)
         else:
-            return None
+            massaged = None
+        if memoize:
+            if len(self.ncx_text_cache) >= self.NCX_TEXT_CACHE_SIZE:
+                self.ncx_text_cache.clear()
+            self.ncx_text_cache[(description, dest)] = massaged
+        return massaged
 
     def generate_author_anchor(self, author):
         """ Generate legal XHTML anchor.
@@ -1011,7 +1299,22 @@ class CatalogBuilder(object):
         Return:
          (str): asciized version of author
         """
-        return re.sub("\W", "", ascii_text(author))
+        return author_anchor(author)
+
+    def generate_book_fingerprint(self, record):
+        """ Generate a digest of the metadata a book is rendered from.
+
+        Digest the record fields consumed by _populate_title(), plus the size
+        and mtime of the cover file. Incremental builds compare it against the
+        previous build manifest to detect changed books.
+
+        Args:
+         record (dict): book metadata from search_sort_db()
+
+        Return:
+         (str): hex digest
+        """
+        return book_fingerprint(record)
 
     def generate_by_authors_list(self, books):
         authors = []
@@ -1047,25 +1350,15 @@ class CatalogBuilder(object):
                 series = None
             author['book_count'] += 1
 
-            # Add books
-            this_book = {}
-            this_book['title'] = book['title']
-            this_book['series'] = book['series']
-            series_index = str(book['series_index'])
-            if series_index.endswith('.0'):
-                series_index = series_index[:-2]
-            this_book['series_idx'] = series_index
-            this_book['pubyear'] = book['date'].split()[1] if book['date'] else None
-            this_book['url'] = "book_%d.html" % (int (float(book['id'])))
-
+            # Add books, templates read url, series_idx and pubyear derived by the record
             if series:
                 if not series.has_key('books'):
                     series['books'] = []
-                series['books'].append(this_book)
+                series['books'].append(book)
             else:
                 if not author.has_key('books'):
                     author['books'] = []
-                author['books'].append(this_book)
+                author['books'].append(book)
         return authors
 
     def generate_html_by_author(self):
@@ -1089,8 +1382,6 @@ class CatalogBuilder(object):
         # Languages
         languages = lang_as_iso639_1(get_lang())
 
-        template = self.load_userfile_or_pluginfile('magic_catalog/magic_author_template.xhtml').decode('utf-8')
-        from calibre.ebooks.oeb.base import XHTML_NS
         args = dict(
             authors=authors,
             title_str=friendly_name,
@@ -1100,16 +1391,13 @@ class CatalogBuilder(object):
         for k, v in args.iteritems():
             if isbytestring(v):
                 args[k] = v.decode('utf-8')
-        generated_html = Templite(template).render(**args)
-        generated_html = substitute_entites(generated_html)
-
-        soup = BeautifulStoneSoup(generated_html)
 
         outfile_spec = "%s/ByAuthor.html" % (self.content_dir)
-        outfile = open(outfile_spec, 'w')
-        outfile.write(soup.prettify())
-        outfile.close()
         self.html_filelist_1.append("content/ByAuthor.html")
+        if self.is_section_current(outfile_spec, args):
+            return
+
+        self.write_section_page('magic_catalog/magic_author_template.xhtml', outfile_spec, args)
 
     def generate_html_by_genres(self):
         """ Generate individual HTML files per tag.
@@ -1119,6 +1407,7 @@ class CatalogBuilder(object):
 
         Inputs:
          self.genre_tags_dict (list): all genre tags
+         self.genre_tag_index (dict): book ids per genre tag
 
         Output:
          (files): HTML file per genre
@@ -1126,44 +1415,35 @@ class CatalogBuilder(object):
 
         self.update_progress_full_step(_("Genres HTML"))
 
+        # Position of each book's first entry in books_by_author
+        author_positions = {}
+        for (i, book) in enumerate(self.books_by_author):
+            author_positions.setdefault(book['id'], i)
+
         # Extract books matching filtered_tags
+        # genre_list => [ {normalized_genre_tag : [{book},{},{}]},
+        #                 {normalized_genre_tag : [{book},{},{}]} ]
         genre_list = []
+        genre_books = {}
+        genre_book_ids = {}
         for friendly_tag in sorted(self.genre_tags_dict, key=sort_key):
-            #print("\ngenerate_html_by_genres(): looking for books with friendly_tag '%s'" % friendly_tag)
-            # tag_list => { normalized_genre_tag : [{book},{},{}],
-            #               normalized_genre_tag : [{book},{},{}] }
-
-            tag_list = {}
-            for book in self.books_by_author:
-                # Scan each book for tag matching friendly_tag
-                if 'genres' in book and friendly_tag in book['genres']:
-                    this_book = {}
-                    this_book['author'] = book['author']
-                    this_book['title'] = book['title']
-                    this_book['author_sort'] = capitalize(book['author_sort'])
-                    this_book['tags'] = book['tags']
-                    this_book['id'] = book['id']
-                    this_book['series'] = book['series']
-                    this_book['series_index'] = book['series_index']
-                    this_book['date'] = book['date']
-                    normalized_tag = self.genre_tags_dict[friendly_tag]
-                    genre_tag_list = [key for genre in genre_list for key in genre]
-                    if normalized_tag in genre_tag_list:
-                        for existing_genre in genre_list:
-                            for key in existing_genre:
-                                new_book = None
-                                if key == normalized_tag:
-                                    for book in existing_genre[key]:
-                                        if book['title'] == this_book['title']:
-                                            new_book = False
-                                            break
-                                    else:
-                                        new_book = True
-                                if new_book:
-                                    existing_genre[key].append(this_book)
-                    else:
-                        tag_list[normalized_tag] = [this_book]
-                        genre_list.append(tag_list)
+            book_ids = [book_id for book_id in self.genre_tag_index.get(friendly_tag, [])
+                        if book_id in author_positions]
+            if not book_ids:
+                continue
+            normalized_tag = self.genre_tags_dict[friendly_tag]
+            if normalized_tag not in genre_books:
+                genre_books[normalized_tag] = []
+                genre_book_ids[normalized_tag] = set()
+                genre_list.append({normalized_tag: genre_books[normalized_tag]})
+
+            # Synonymous tags add books not already listed, in books_by_author order
+            for book_id in sorted(book_ids, key=author_positions.get):
+                if book_id in genre_book_ids[normalized_tag]:
+                    continue
+                genre_book_ids[normalized_tag].add(book_id)
+                # Book records and author views are listed as they are
+                genre_books[normalized_tag].append(self.books_by_author[author_positions[book_id]])
 
         if self.opts.verbose:
             if len(genre_list):
@@ -1186,7 +1466,7 @@ class CatalogBuilder(object):
                 # Create sorted_authors[0] = friendly, [1] = author_sort for NCX creation
                 authors = []
                 for book in genre_tag_set[genre]:
-                    authors.append((book['author'], book['author_sort']))
+                    authors.append((book['author'], book['sort_author']))
 
                 # authors[] contains a list of all book authors, with multiple entries for multiple books by author
                 # Create unique_authors with a count of books per author as the third tuple element
@@ -1245,8 +1525,6 @@ class CatalogBuilder(object):
         languages = lang_as_iso639_1(get_lang())
         friendly_name = escape(self.get_friendly_genre_tag(genre))
 
-        template = self.load_userfile_or_pluginfile('magic_catalog/magic_author_template.xhtml').decode('utf-8')
-        from calibre.ebooks.oeb.base import XHTML_NS
         args = dict(
             authors=authors,
             title_str=friendly_name,
@@ -1256,15 +1534,10 @@ class CatalogBuilder(object):
         for k, v in args.iteritems():
             if isbytestring(v):
                 args[k] = v.decode('utf-8')
-        generated_html = Templite(template).render(**args)
-        generated_html = substitute_entites(generated_html)
 
-        soup = BeautifulStoneSoup(generated_html)
-
-        # Write the generated file to content_dir
-        outfile = open(outfile, 'w')
-        outfile.write(soup.prettify())
-        outfile.close()
+        if not self.is_section_current(outfile, args):
+            # Write the generated file to content_dir
+            self.write_section_page('magic_catalog/magic_author_template.xhtml', outfile, args)
 
         if len(books) > 1:
             titles_spanned = [(books[0]['author'], books[0]['title']), (books[-1]['author'], books[-1]['title'])]
@@ -1285,17 +1558,9 @@ class CatalogBuilder(object):
                 series['id'] = self.generate_series_anchor(current_series)
                 series['books'] = []
                 serieses.append(series)
-            this_book = {}
-            this_book['author'] = book['author']
-            this_book['author_url'] = "ByAuthor.html#%s" % self.generate_author_anchor(book['author'])
-            this_book['title'] = book['title']
-            series_index = str(book['series_index'])
-            if series_index.endswith('.0'):
-                series_index = series_index[:-2]
-            this_book['series_index'] = series_index
-            this_book['pubyear'] = book['date'].split()[1] if book['date'] else None
-            this_book['url'] = "book_%d.html" % (int (float(book['id'])))
-            series['books'].append(this_book)
+            # Templates read series_index as its display string, author_url,
+            # pubyear and url derived by the record
+            series['books'].append(SeriesView(book))
         return serieses
 
     def generate_html_by_series(self):
@@ -1317,7 +1582,7 @@ class CatalogBuilder(object):
 
         # *** Convert the existing database, resort by series/index ***
         self.books_by_series = [i for i in self.books_to_catalog if i['series']]
-        self.books_by_series = sorted(self.books_by_series, key=lambda x: sort_key(self._kf_books_by_series_sorter(x)))
+        self.books_by_series = sorted(self.books_by_series, key=lambda x: x['series_sort_key'])
 
         if not self.books_by_series:
             self.opts.generate_series = False
@@ -1329,8 +1594,6 @@ class CatalogBuilder(object):
         # Languages
         languages = lang_as_iso639_1(get_lang())
 
-        template = self.load_userfile_or_pluginfile('magic_catalog/magic_series_template.xhtml').decode('utf-8')
-        from calibre.ebooks.oeb.base import XHTML_NS
         args = dict(
             serieses=serieses,
             title_str=friendly_name,
@@ -1340,16 +1603,13 @@ class CatalogBuilder(object):
         for k, v in args.iteritems():
             if isbytestring(v):
                 args[k] = v.decode('utf-8')
-        generated_html = Templite(template).render(**args)
-        generated_html = substitute_entites(generated_html)
-        soup = BeautifulStoneSoup(generated_html)
 
         outfile_spec = "%s/BySeries.html" % (self.content_dir)
-
-        outfile = open(outfile_spec, 'w')
-        outfile.write(soup.prettify())
-        outfile.close()
         self.html_filelist_1.append("content/BySeries.html")
+        if self.is_section_current(outfile_spec, args):
+            return
+
+        self.write_section_page('magic_catalog/magic_series_template.xhtml', outfile_spec, args)
 
     def generate_html_description_header(self, book):
         """ Generate the HTML Description header from template.
@@ -1364,7 +1624,6 @@ class CatalogBuilder(object):
          soup (BeautifulSoup): HTML Description for book
         """
 
-        from calibre.ebooks.oeb.base import XHTML_NS
 
         def _generate_html():
             args = dict(
@@ -1394,8 +1653,8 @@ class CatalogBuilder(object):
             for k, v in args.iteritems():
                 if isbytestring(v):
                     args[k] = v.decode('utf-8')
-            template = self.load_userfile_or_pluginfile('magic_catalog/magic_template.xhtml').decode('utf-8')
-            generated_html = Templite(template).render(**args)
+            render = self.get_template_renderer('magic_catalog/magic_template.xhtml')
+            generated_html = render(**args)
             generated_html = substitute_entites(generated_html)
 
             return BeautifulSoup(generated_html)
@@ -1542,30 +1801,148 @@ class CatalogBuilder(object):
     def generate_html_descriptions(self):
         """ Generate Description HTML for each book.
 
-        Loop though books, write Description HTML for each book.
+        Loop though description_files, write the Description HTML of their
+        books. With opts.worker_count > 1, files are rendered in chunks by a
+        pool of forked worker processes, see
+        generate_html_descriptions_parallel().
 
         Inputs:
-         books_by_title (list)
+         description_files (list)
 
         Output:
          (files): Description HTML for each book
         """
 
+        def _is_reusable(title):
+            previous = self.get_previous_book_entry(title)
+            return (previous is not None and
+                    previous.get('thumb') == self.build_manifest['books'][str(title['id'])].get('thumb'))
+
         self.update_progress_full_step(_("Descriptions HTML"))
 
-        for (title_num, title) in enumerate(self.books_by_title):
+        # Skip files reusable from the previous build: same books, all unchanged
+        pending = []
+        if self.incremental:
+            previous_files = self.previous_manifest.get('descriptions', {})
+            self.build_manifest['descriptions'] = {}
+        for (file_num, (file_name, item_id, books)) in enumerate(self.description_files):
+            if self.incremental:
+                book_ids = [book['id'] for book in books]
+                self.build_manifest['descriptions'][file_name] = book_ids
+                if (previous_files.get(file_name) == book_ids and
+                        os.path.exists(os.path.join(self.content_dir, file_name)) and
+                        all(_is_reusable(book) for book in books)):
+                    continue
+            pending.append(file_num)
+
+        if (self.opts.worker_count > 1 and hasattr(os, 'fork') and
+                sum(len(self.description_files[i][2]) for i in pending) > self.RENDER_CHUNK_SIZE):
+            self.generate_html_descriptions_parallel(pending)
+            return
+
+        completed = 0
+        for file_num in pending:
+            (file_name, item_id, books) = self.description_files[file_num]
+            completed += len(books)
             self.update_progress_micro_step("%s %d of %d" %
                                             (_("Description HTML"),
-                                            title_num, len(self.books_by_title)),
-                                            float(title_num * 100 / len(self.books_by_title)) / 100)
+                                            completed, len(self.books_by_description)),
+                                            float(completed * 100 / len(self.books_by_description)) / 100)
+
+            # Write the book entries to content_dir
+            self.write_html_description(file_name, self.generate_html_description_file(books))
+
+    def generate_html_description_file(self, books):
+        """ Render the Description HTML file of one or more books.
+
+        A single book is rendered as its Description page. Several books
+        share the head of the first page, the body of each page is wrapped
+        in a <div class="description_page">, starting a new page. The
+        book<id> anchors are kept.
+
+        Args:
+         books (list): books of the file, in reading order
+
+        Return:
+         (str): rendered Description HTML
+        """
+        if len(books) == 1:
+            return self.generate_html_description_header(books[0]).prettify()
 
+        soup = None
+        for book in books:
             # Generate the header from user-customizable template
-            soup = self.generate_html_description_header(title)
+            book_soup = self.generate_html_description_header(book)
+            body = book_soup.find('body')
+            pageTag = Tag(book_soup, 'div')
+            pageTag['class'] = "description_page"
+            for (i, child) in enumerate(list(body.contents)):
+                pageTag.insert(i, child)
+            if soup is None:
+                soup = book_soup
+                pages = body
+            pages.insert(len(pages.contents), pageTag)
+        return soup.prettify()
+
+    def generate_html_descriptions_parallel(self, pending):
+        """ Generate Description HTML for books using a process pool.
+
+        Farm out chunks of description files to forked worker processes, which
+        inherit the state of the builder. Rendered pages are streamed to
+        content_dir as chunks complete. Workers render through the same
+        generate_html_description_file() path as the serial loop, so the
+        output is byte-identical.
 
-            # Write the book entry to content_dir
-            outfile = open("%s/book_%d.html" % (self.content_dir, int(title['id'])), 'w')
-            outfile.write(soup.prettify())
-            outfile.close()
+        Args:
+         pending (list): indices into description_files of files to render
+
+        Output:
+         (files): Description HTML for each pending file
+        """
+        global _worker_builder
+
+        # About RENDER_CHUNK_SIZE books per chunk
+        files_per_chunk = max(self.RENDER_CHUNK_SIZE // self.opts.descriptions_per_file, 1)
+        chunks = [pending[i:i + files_per_chunk]
+                  for i in range(0, len(pending), files_per_chunk)]
+        workers = min(self.opts.worker_count, len(chunks))
+        if self.opts.verbose:
+            self.opts.log.info("  rendering %d description files in %d chunks, %d workers" %
+                               (len(pending), len(chunks), workers))
+
+        completed = len(self.books_by_description) - sum(len(self.description_files[i][2]) for i in pending)
+        _worker_builder = self
+        pool = Pool(processes=workers)
+        try:
+            for rendered in pool.imap_unordered(_render_html_descriptions, chunks):
+                for (file_name, book_count, html) in rendered:
+                    self.write_html_description(file_name, html)
+                    completed += book_count
+                self.update_progress_micro_step("%s %d of %d" %
+                                                (_("Description HTML"),
+                                                completed, len(self.books_by_description)),
+                                                float(completed * 100 / len(self.books_by_description)) / 100)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _worker_builder = None
+
+    def generate_library_id(self):
+        """ Generate a filesystem-safe id for the current library.
+
+        Inputs:
+         library_base_path (str): path to the calibre library
+
+        Return:
+         (str): hex digest of the library path
+        """
+        library_path = self.library_base_path
+        if not isbytestring(library_path):
+            library_path = library_path.encode('utf-8')
+        return hashlib.md5(library_path).hexdigest()
 
     def generate_masthead_image(self, out_path):
         """ Generate a Kindle masthead image.
@@ -1624,59 +2001,45 @@ class CatalogBuilder(object):
     def generate_ncx_header(self):
         """ Generate the basic NCX file.
 
-        Generate the initial NCX, which is added to depending on included Sections.
+        Start the NCX, which is added to depending on included Sections.
+        navPoints are streamed to the file as the Sections are generated,
+        the top-level navPoint stays open until write_ncx().
 
         Inputs:
-         None
+         catalog_path (str): path to generated catalog
+         opts.basename (str): catalog basename
 
         Updated:
          play_order (int)
 
         Outputs:
-         ncx_soup (file): NCX foundation
+         ncx_writer (XMLWriter): NCX foundation written
         """
 
         self.update_progress_full_step(_("NCX header"))
 
-        header = '''
-            <?xml version="1.0" encoding="utf-8"?>
-            <ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" xmlns:calibre="http://calibre.kovidgoyal.net/2009/metadata" version="2005-1" xml:lang="en">
-            </ncx>
-        '''
-        soup = BeautifulStoneSoup(header, selfClosingTags=['content', 'calibre:meta-img'])
-
-        ncx = soup.find('ncx')
-        navMapTag = Tag(soup, 'navMap')
+        ncx = XMLWriter("%s/%s.ncx" % (self.catalog_path, self.opts.basename))
+        ncx.start('ncx', [('xmlns', "http://www.daisy.org/z3986/2005/ncx/"),
+                          ('xmlns:calibre', "http://calibre.kovidgoyal.net/2009/metadata"),
+                          ('version', "2005-1"),
+                          ('xml:lang', "en")])
+        ncx.start('navMap')
 
         # Build a top-level navPoint for Kindle periodicals
-        navPointTag = Tag(soup, 'navPoint')
-        navPointTag['class'] = "periodical"
-        navPointTag['id'] = "title"
-        navPointTag['playOrder'] = self.play_order
+        ncx.start('navPoint', [('class', "periodical"),
+                               ('id', "title"),
+                               ('playOrder', self.play_order)])
         self.play_order += 1
-        navLabelTag = Tag(soup, 'navLabel')
-        textTag = Tag(soup, 'text')
-        textTag.insert(0, NavigableString(self.opts.catalog_title))
-        navLabelTag.insert(0, textTag)
-        navPointTag.insert(0, navLabelTag)
-
-        contentTag = Tag(soup, 'content')
-        contentTag['src'] = "content/ByAuthor.html"
-        navPointTag.insert(1, contentTag)
-
-        cmiTag = Tag(soup, '%s' % 'calibre:meta-img')
-        cmiTag['id'] = "mastheadImage"
-        cmiTag['src'] = "images/mastheadImage.gif"
-        navPointTag.insert(2, cmiTag)
-        navMapTag.insert(0, navPointTag)
-
-        ncx.insert(0, navMapTag)
-        self.ncx_soup = soup
+        self.write_ncx_label(ncx, self.opts.catalog_title)
+        ncx.element('content', [('src', "content/ByAuthor.html")])
+        ncx.element('calibre:meta-img', [('id', "mastheadImage"),
+                                         ('src', "images/mastheadImage.gif")])
+        self.ncx_writer = ncx
 
     def generate_ncx_descriptions(self, tocTitle):
         """ Add Descriptions to the basic NCX file.
 
-        Generate the Descriptions NCX content, add to self.ncx_soup.
+        Generate the Descriptions NCX content, write to self.ncx_writer.
 
         Inputs:
          books_by_author (list)
@@ -1685,100 +2048,83 @@ class CatalogBuilder(object):
          play_order (int)
 
         Outputs:
-         ncx_soup (file): updated
+         ncx_writer (XMLWriter): updated
         """
 
         self.update_progress_full_step(_("NCX for Descriptions"))
 
         # --- Construct the 'Descriptions' section ---
-        ncx_soup = self.ncx_soup
-        body = ncx_soup.find("navPoint")
-        btc = len(body.contents)
+        ncx = self.ncx_writer
 
         # Add the section navPoint
-        navPointTag = Tag(ncx_soup, 'navPoint')
-        navPointTag['class'] = "section"
-        navPointTag['id'] = "bydescription-ID"
-        navPointTag['playOrder'] = self.play_order
+        ncx.start('navPoint', [('class', "section"),
+                               ('id', "bydescription-ID"),
+                               ('playOrder', self.play_order)])
         self.play_order += 1
-        navLabelTag = Tag(ncx_soup, 'navLabel')
-        textTag = Tag(ncx_soup, 'text')
         section_header = '%s [%d]' % (tocTitle, len(self.books_by_description))
         section_header = tocTitle
-        textTag.insert(0, NavigableString(section_header))
-        navLabelTag.insert(0, textTag)
-        nptc = 0
-        navPointTag.insert(nptc, navLabelTag)
-        nptc += 1
-        contentTag = Tag(ncx_soup, "content")
-        contentTag['src'] = "content/book_%d.html" % int(self.books_by_description[0]['id'])
-        navPointTag.insert(nptc, contentTag)
-        nptc += 1
+        self.write_ncx_label(ncx, section_header)
+        ncx.element('content', [('src', "content/%s" % self.description_files[0][0])])
 
         # Loop over the titles
 
         for book in self.books_by_description:
-            navPointVolumeTag = Tag(ncx_soup, 'navPoint')
-            navPointVolumeTag['class'] = "article"
-            navPointVolumeTag['id'] = "book%dID" % int(book['id'])
-            navPointVolumeTag['playOrder'] = self.play_order
+            ncx.start('navPoint', [('class', "article"),
+                                   ('id', "book%dID" % int(book['id'])),
+                                   ('playOrder', self.play_order)])
             self.play_order += 1
-            navLabelTag = Tag(ncx_soup, "navLabel")
-            textTag = Tag(ncx_soup, "text")
-            if book['series']:
-                series_index = str(book['series_index'])
-                if series_index.endswith('.0'):
-                    series_index = series_index[:-2]
-                # Don't include Author for Kindle
-                textTag.insert(0, NavigableString(self.format_ncx_text('%s (%s [%s])' %
-                                                                       (book['title'], book['series'], series_index), dest='title')))
+            # Reuse the NCX text from the previous build if unchanged
+            previous = self.get_previous_book_entry(book)
+            if previous is not None and 'ncx' in previous:
+                title_str, navStr, description_str = previous['ncx']
             else:
-                # Don't include Author for Kindle
-                title_str = self.format_ncx_text('%s' % (book['title']), dest='title')
-                textTag.insert(0, NavigableString(title_str))
-            navLabelTag.insert(0, textTag)
-            navPointVolumeTag.insert(0, navLabelTag)
+                if book['series']:
+                    series_index = str(book['series_index'])
+                    if series_index.endswith('.0'):
+                        series_index = series_index[:-2]
+                    # Don't include Author for Kindle
+                    title_str = self.format_ncx_text('%s (%s [%s])' %
+                                                     (book['title'], book['series'], series_index), dest='title')
+                else:
+                    # Don't include Author for Kindle
+                    title_str = self.format_ncx_text('%s' % (book['title']), dest='title')
 
-            contentTag = Tag(ncx_soup, "content")
-            contentTag['src'] = "content/book_%d.html#book%d" % (int(book['id']), int(book['id']))
-            navPointVolumeTag.insert(1, contentTag)
+                if book['date']:
+                    navStr = '%s | %s' % (self.format_ncx_text(book['author'], dest='author'),
+                                          book['date'].split()[1])
+                else:
+                    navStr = '%s' % (self.format_ncx_text(book['author'], dest='author'))
 
-            # Add the author tag
-            cmTag = Tag(ncx_soup, '%s' % 'calibre:meta')
-            cmTag['name'] = "author"
+                if 'tags' in book and len(book['tags']):
+                    navStr = self.format_ncx_text(navStr + ' | ' + ' &middot; '.join(sorted(book['tags'])), dest='author')
 
-            if book['date']:
-                navStr = '%s | %s' % (self.format_ncx_text(book['author'], dest='author'),
-                                      book['date'].split()[1])
-            else:
-                navStr = '%s' % (self.format_ncx_text(book['author'], dest='author'))
+                description_str = None
+                if book['short_description']:
+                    description_str = self.format_ncx_text(book['short_description'], dest='description')
+
+            if self.incremental:
+                self.build_manifest['books'][str(book['id'])]['ncx'] = [title_str, navStr, description_str]
 
-            if 'tags' in book and len(book['tags']):
-                navStr = self.format_ncx_text(navStr + ' | ' + ' &middot; '.join(sorted(book['tags'])), dest='author')
-            cmTag.insert(0, NavigableString(navStr))
-            navPointVolumeTag.insert(2, cmTag)
+            self.write_ncx_label(ncx, title_str)
+            description_file = book.get('description_file', "book_%d.html" % int(book['id']))
+            ncx.element('content', [('src', "content/%s#book%d" % (description_file, int(book['id'])))])
+
+            # Add the author tag
+            ncx.element('calibre:meta', [('name', "author")], navStr or u'')
 
             # Add the description tag
             if book['short_description']:
-                cmTag = Tag(ncx_soup, '%s' % 'calibre:meta')
-                cmTag['name'] = "description"
-                cmTag.insert(0, NavigableString(self.format_ncx_text(book['short_description'], dest='description')))
-                navPointVolumeTag.insert(3, cmTag)
+                ncx.element('calibre:meta', [('name', "description")], description_str or u'')
 
-            # Add this volume to the section tag
-            navPointTag.insert(nptc, navPointVolumeTag)
-            nptc += 1
+            ncx.end()
 
-        # Add this section to the body
-        body.insert(btc, navPointTag)
-        btc += 1
-
-        self.ncx_soup = ncx_soup
+        # Close this section
+        ncx.end()
 
     def generate_ncx_by_series(self, tocTitle):
         """ Add Series to the basic NCX file.
 
-        Generate the Series NCX content, add to self.ncx_soup.
+        Generate the Series NCX content, write to self.ncx_writer.
 
         Inputs:
          books_by_series (list)
@@ -1787,34 +2133,13 @@ class CatalogBuilder(object):
          play_order (int)
 
         Outputs:
-         ncx_soup (file): updated
+         ncx_writer (XMLWriter): updated
         """
 
         self.update_progress_full_step(_("NCX for Series"))
 
-        ncx_soup = self.ncx_soup
+        ncx = self.ncx_writer
         HTML_file = "content/BySeries.html"
-        body = ncx_soup.find("navPoint")
-        btc = len(body.contents)
-
-        # --- Construct the 'Books By Series' section ---
-        navPointTag = Tag(ncx_soup, 'navPoint')
-        navPointTag['class'] = "section"
-        navPointTag['id'] = "byseries-ID"
-        navPointTag['playOrder'] = self.play_order
-        self.play_order += 1
-        navLabelTag = Tag(ncx_soup, 'navLabel')
-        textTag = Tag(ncx_soup, 'text')
-        section_header = tocTitle
-        textTag.insert(0, NavigableString(section_header))
-        navLabelTag.insert(0, textTag)
-        nptc = 0
-        navPointTag.insert(nptc, navLabelTag)
-        nptc += 1
-        contentTag = Tag(ncx_soup, "content")
-        contentTag['src'] = "%s#section_start" % HTML_file
-        navPointTag.insert(nptc, contentTag)
-        nptc += 1
 
         # Establish initial letter equivalencies
         #sort_equivalents = self.establish_equivalencies(self.books_by_series, key='series_sort')
@@ -1824,40 +2149,33 @@ class CatalogBuilder(object):
 
         serieses = self.generate_by_series_list(self.books_by_series)
 
-        for idx, series in enumerate(serieses):
-            navPointBySeriesTag = Tag(ncx_soup, 'navPoint')
-            navPointBySeriesTag['class'] = "article"
-            navPointBySeriesTag['id'] = "%sSeries-ID" % series['id']
-            navPointTag['playOrder'] = self.play_order
-            self.play_order += 1
+        # --- Construct the 'Books By Series' section ---
+        # Each series takes a play_order, the section navPoint carries the
+        # last one, series navPoints carry none
+        ncx.start('navPoint', [('class', "section"),
+                               ('id', "byseries-ID"),
+                               ('playOrder', self.play_order + len(serieses))])
+        self.play_order += 1 + len(serieses)
+        section_header = tocTitle
+        self.write_ncx_label(ncx, section_header)
+        ncx.element('content', [('src', "%s#section_start" % HTML_file)])
 
-            navLabelTag = Tag(ncx_soup, 'navLabel')
-            textTag = Tag(ncx_soup, 'text')
-            textTag.insert(0, NavigableString(series['name']))
-            navLabelTag.insert(0, textTag)
-            navPointBySeriesTag.insert(0, navLabelTag)
-            contentTag = Tag(ncx_soup, 'content')
-            contentTag['src'] = "%s#%s" % (HTML_file, series['id'])
-            navPointBySeriesTag.insert(1, contentTag)
-
-            cmTag = Tag(ncx_soup, '%s' % 'calibre:meta')
-            cmTag['name'] = "description"
-            cmTag.insert(0, NavigableString(self.format_ncx_text(series['name'], dest='description')))
-            navPointBySeriesTag.insert(2, cmTag)
-
-            navPointTag.insert(nptc, navPointBySeriesTag)
-            nptc += 1
-
-        # Add this section to the body
-        body.insert(btc, navPointTag)
-        btc += 1
+        for idx, series in enumerate(serieses):
+            ncx.start('navPoint', [('class', "article"),
+                                   ('id', "%sSeries-ID" % series['id'])])
+            self.write_ncx_label(ncx, series['name'])
+            ncx.element('content', [('src', "%s#%s" % (HTML_file, series['id']))])
+            ncx.element('calibre:meta', [('name', "description")],
+                        self.format_ncx_text(series['name'], dest='description') or u'')
+            ncx.end()
 
-        self.ncx_soup = ncx_soup
+        # Close this section
+        ncx.end()
 
     def generate_ncx_by_author(self, tocTitle):
         """ Add Authors to the basic NCX file.
 
-        Generate the Authors NCX content, add to self.ncx_soup.
+        Generate the Authors NCX content, write to self.ncx_writer.
 
         Inputs:
          authors (list)
@@ -1866,77 +2184,45 @@ class CatalogBuilder(object):
          play_order (int)
 
         Outputs:
-         ncx_soup (file): updated
+         ncx_writer (XMLWriter): updated
         """
 
         self.update_progress_full_step(_("NCX for Authors"))
 
-        ncx_soup = self.ncx_soup
+        ncx = self.ncx_writer
         HTML_file = "content/ByAuthor.html"
-        body = ncx_soup.find("navPoint")
-        btc = len(body.contents)
+
+        authors = self.generate_by_authors_list(self.books_by_author)
 
         # --- Construct the 'Books By Author' *section* ---
-        navPointTag = Tag(ncx_soup, 'navPoint')
-        navPointTag['class'] = "section"
+        # Each author takes a play_order, the section navPoint carries the
+        # last one, author navPoints carry none
         file_ID = "%s" % tocTitle.lower()
         file_ID = file_ID.replace(" ", "")
-        navPointTag['id'] = "%s-ID" % file_ID
-        navPointTag['playOrder'] = self.play_order
-        self.play_order += 1
-        navLabelTag = Tag(ncx_soup, 'navLabel')
-        textTag = Tag(ncx_soup, 'text')
+        ncx.start('navPoint', [('class', "section"),
+                               ('id', "%s-ID" % file_ID),
+                               ('playOrder', self.play_order + len(authors))])
+        self.play_order += 1 + len(authors)
         section_header = tocTitle
-        textTag.insert(0, NavigableString(section_header))
-        navLabelTag.insert(0, textTag)
-        nptc = 0
-        navPointTag.insert(nptc, navLabelTag)
-        nptc += 1
-        contentTag = Tag(ncx_soup, "content")
-        contentTag['src'] = "%s#section_start" % HTML_file
-        navPointTag.insert(nptc, contentTag)
-        nptc += 1
-
-        authors = self.generate_by_authors_list(self.books_by_author)
+        self.write_ncx_label(ncx, section_header)
+        ncx.element('content', [('src', "%s#section_start" % HTML_file)])
 
         for idx, author in enumerate(authors):
-            navPointByAuthorTag = Tag(ncx_soup, 'navPoint')
-            navPointByAuthorTag['class'] = "article"
-            navPointByAuthorTag['id'] = "%sauthors-ID" % author['id']
-            navPointTag['playOrder'] = self.play_order
-            self.play_order += 1
-            
-            navLabelTag = Tag(ncx_soup, 'navLabel')
-            textTag = Tag(ncx_soup, 'text')
-            textTag.insert(0, NavigableString(author['name']))
-            navLabelTag.insert(0, textTag)
-            navPointByAuthorTag.insert(0, navLabelTag)
-            contentTag = Tag(ncx_soup, 'content')
-            contentTag['src'] = "%s#%s" % (HTML_file, author['id'])
-            navPointByAuthorTag.insert(1, contentTag)
-
-            cmTag = Tag(ncx_soup, '%s' % 'calibre:meta')
-            cmTag['name'] = 'author'
-            cmTag.insert(0, NavigableString(author['name']))
-            navPointByAuthorTag.insert(2, cmTag)
-            cmTag = Tag(ncx_soup, '%s' % 'calibre:meta')
-            cmTag['name'] = 'description'
-            cmTag.insert(0, NavigableString(author['name'])); # @@@mada
-            navPointByAuthorTag.insert(3, cmTag);
-
-            navPointTag.insert(nptc, navPointByAuthorTag)
-            nptc += 1
-
-        # Add this section to the body
-        body.insert(btc, navPointTag)
-        btc += 1
+            ncx.start('navPoint', [('class', "article"),
+                                   ('id', "%sauthors-ID" % author['id'])])
+            self.write_ncx_label(ncx, author['name'])
+            ncx.element('content', [('src', "%s#%s" % (HTML_file, author['id']))])
+            ncx.element('calibre:meta', [('name', 'author')], author['name'])
+            ncx.element('calibre:meta', [('name', 'description')], author['name']) # @@@mada
+            ncx.end()
 
-        self.ncx_soup = ncx_soup
+        # Close this section
+        ncx.end()
 
     def generate_ncx_by_genre(self, tocTitle):
         """ Add Genres to the basic NCX file.
 
-        Generate the Genre NCX content, add to self.ncx_soup.
+        Generate the Genre NCX content, write to self.ncx_writer.
 
         Inputs:
          genres (list)
@@ -1945,7 +2231,7 @@ class CatalogBuilder(object):
          play_order (int)
 
         Outputs:
-         ncx_soup (file): updated
+         ncx_writer (XMLWriter): updated
         """
 
         self.update_progress_full_step(_("NCX for Genres"))
@@ -1955,57 +2241,32 @@ class CatalogBuilder(object):
                                 " No Genre section added to Catalog")
             return
 
-        ncx_soup = self.ncx_soup
-        body = ncx_soup.find("navPoint")
-        btc = len(body.contents)
+        ncx = self.ncx_writer
 
         # --- Construct the 'Books By Genre' *section* ---
-        navPointTag = Tag(ncx_soup, 'navPoint')
-        navPointTag['class'] = "section"
         file_ID = "%s" % tocTitle.lower()
         file_ID = file_ID.replace(" ", "")
-        navPointTag['id'] = "%s-ID" % file_ID
-        navPointTag['playOrder'] = self.play_order
+        ncx.start('navPoint', [('class', "section"),
+                               ('id', "%s-ID" % file_ID),
+                               ('playOrder', self.play_order)])
         self.play_order += 1
-        navLabelTag = Tag(ncx_soup, 'navLabel')
-        textTag = Tag(ncx_soup, 'text')
         section_header = tocTitle
-        textTag.insert(0, NavigableString(section_header))
-        navLabelTag.insert(0, textTag)
-        nptc = 0
-        navPointTag.insert(nptc, navLabelTag)
-        nptc += 1
-        contentTag = Tag(ncx_soup, "content")
-        contentTag['src'] = "content/Genre_%s.html#section_start" % self.genres[0]['tag']
-        navPointTag.insert(nptc, contentTag)
-        nptc += 1
+        self.write_ncx_label(ncx, section_header)
+        ncx.element('content', [('src', "content/Genre_%s.html#section_start" % self.genres[0]['tag'])])
 
         for genre in self.genres:
             # Add an article for each genre
-            navPointVolumeTag = Tag(ncx_soup, 'navPoint')
-            navPointVolumeTag['class'] = "article"
-            navPointVolumeTag['id'] = "genre-%s-ID" % genre['tag']
-            navPointVolumeTag['playOrder'] = self.play_order
+            ncx.start('navPoint', [('class', "article"),
+                                   ('id', "genre-%s-ID" % genre['tag']),
+                                   ('playOrder', self.play_order)])
             self.play_order += 1
-            navLabelTag = Tag(ncx_soup, "navLabel")
-            textTag = Tag(ncx_soup, "text")
-
-            # GwR *** Can this be optimized?
-            normalized_tag = None
-            for friendly_tag in self.genre_tags_dict:
-                if self.genre_tags_dict[friendly_tag] == genre['tag']:
-                    normalized_tag = self.genre_tags_dict[friendly_tag]
-                    break
-            textTag.insert(0, self.format_ncx_text(NavigableString(friendly_tag), dest='description'))
-            navLabelTag.insert(0, textTag)
-            navPointVolumeTag.insert(0, navLabelTag)
-            contentTag = Tag(ncx_soup, "content")
-            contentTag['src'] = "content/Genre_%s.html" % (normalized_tag)
-            navPointVolumeTag.insert(1, contentTag)
+
+            normalized_tag = genre['tag']
+            friendly_tag = self.get_friendly_genre_tag(normalized_tag)
+            self.write_ncx_label(ncx, self.format_ncx_text(NavigableString(friendly_tag), dest='description'))
+            ncx.element('content', [('src', "content/Genre_%s.html" % (normalized_tag))])
 
             # Build the author tag
-            cmTag = Tag(ncx_soup, '%s' % 'calibre:meta')
-            cmTag['name'] = "author"
             # First - Last author
 
             if len(genre['titles_spanned']) > 1:
@@ -2013,208 +2274,151 @@ class CatalogBuilder(object):
             else:
                 author_range = "%s" % (genre['titles_spanned'][0][0])
 
-            cmTag.insert(0, NavigableString(author_range))
-            navPointVolumeTag.insert(2, cmTag)
+            ncx.element('calibre:meta', [('name', "author")], author_range)
 
             # Build the description tag
-            cmTag = Tag(ncx_soup, '%s' % 'calibre:meta')
-            cmTag['name'] = "description"
-
             if False:
                 # Form 1: Titles spanned
                 if len(genre['titles_spanned']) > 1:
                     title_range = "%s -\n%s" % (genre['titles_spanned'][0][1], genre['titles_spanned'][1][1])
                 else:
                     title_range = "%s" % (genre['titles_spanned'][0][1])
-                cmTag.insert(0, NavigableString(self.format_ncx_text(title_range, dest='description')))
+                description = self.format_ncx_text(title_range, dest='description')
             else:
                 # Form 2: title &bull; title &bull; title ...
-                titles = []
-                for title in genre['books']:
-                    titles.append(title['title'])
-                titles = sorted(titles, key=lambda x: (self.generate_sort_title(x), self.generate_sort_title(x)))
+                titles = [book['title'] for book in sorted(genre['books'], key=lambda x: x['title_sort'])]
                 titles_list = self.generate_short_description(u" &bull; ".join(titles), dest="description")
-                cmTag.insert(0, NavigableString(self.format_ncx_text(titles_list, dest='description')))
+                description = self.format_ncx_text(titles_list, dest='description')
 
-            navPointVolumeTag.insert(3, cmTag)
+            ncx.element('calibre:meta', [('name', "description")], description or u'')
 
-            # Add this volume to the section tag
-            navPointTag.insert(nptc, navPointVolumeTag)
-            nptc += 1
+            ncx.end()
 
-        # Add this section to the body
-        body.insert(btc, navPointTag)
-        btc += 1
-        self.ncx_soup = ncx_soup
+        # Close this section
+        ncx.end()
 
     def generate_opf(self):
         """ Generate the OPF file.
 
-        Start with header template, construct manifest, spine and guide.
+        Write metadata, manifest, spine and guide directly to the OPF file.
+        Content documents are listed by a generator walked once for the
+        manifest and once for the spine.
 
         Inputs:
+         description_files (list)
          genres (list)
          html_filelist_1 (list)
          html_filelist_2 (list)
          thumbs (list)
 
-        Updated:
-         play_order (int)
-
         Outputs:
          opts.basename + '.opf' (file): written
         """
 
+        def _content_files():
+            # (href, id) of content documents, in spine order
+            for file in self.html_filelist_1:
+                # By Author, By Title, By Series,
+                yield file, file[file.find('/') + 1:file.find('.')].lower()
+
+            # Genre files
+            for genre in self.genres:
+                file = genre['file']
+                yield file, file[file.find('/') + 1:file.find('.')].lower()
+
+            for file in self.html_filelist_2:
+                # By Date Added, By Date Read
+                yield file, file[file.find('/') + 1:file.find('.')].lower()
+
+            for (file_name, item_id, books) in self.description_files:
+                yield "content/%s" % file_name, item_id
+
         self.update_progress_full_step(_("Generating OPF"))
 
-        header = '''
-            <?xml version="1.0" encoding="UTF-8"?>
-            <package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="calibre_id">
-                <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf" xmlns:calibre="http://calibre.kovidgoyal.net/2009/metadata" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
-                    <dc:language>en-US</dc:language>
-                </metadata>
-                <manifest></manifest>
-                <spine toc="ncx"></spine>
-                <guide></guide>
-            </package>
-            '''
+        opf = XMLWriter("%s/%s.opf" % (self.catalog_path, self.opts.basename),
+                        declaration='<?xml version="1.0" encoding="UTF-8"?>')
+        opf.start('package', [('xmlns', "http://www.idpf.org/2007/opf"),
+                              ('version', "2.0"),
+                              ('unique-identifier', "calibre_id")])
+
         # Add the supplied metadata tags
-        soup = BeautifulStoneSoup(header, selfClosingTags=['item', 'itemref', 'meta', 'reference'])
-        metadata = soup.find('metadata')
-        mtc = 0
-
-        titleTag = Tag(soup, "dc:title")
-        titleTag.insert(0, escape(self.opts.catalog_title))
-        metadata.insert(mtc, titleTag)
-        mtc += 1
-
-        creatorTag = Tag(soup, "dc:creator")
-        creatorTag.insert(0, self.opts.creator)
-        metadata.insert(mtc, creatorTag)
-        mtc += 1
-
-        periodicalTag = Tag(soup, "meta")
-        periodicalTag['name'] = "calibre:publication_type"
-        periodicalTag['content'] = "periodical:default"
-        metadata.insert(mtc, periodicalTag)
-        mtc += 1
-
-        # Create the OPF tags
-        manifest = soup.find('manifest')
-        mtc = 0
-        spine = soup.find('spine')
-        stc = 0
-        guide = soup.find('guide')
-
-        itemTag = Tag(soup, "item")
-        itemTag['id'] = "ncx"
-        itemTag['href'] = '%s.ncx' % self.opts.basename
-        itemTag['media-type'] = "application/x-dtbncx+xml"
-        manifest.insert(mtc, itemTag)
-        mtc += 1
-
-        itemTag = Tag(soup, "item")
-        itemTag['id'] = 'stylesheet'
-        itemTag['href'] = self.stylesheet
-        itemTag['media-type'] = 'text/css'
-        manifest.insert(mtc, itemTag)
-        mtc += 1
-
-        itemTag = Tag(soup, "item")
-        itemTag['id'] = 'mastheadimage-image'
-        itemTag['href'] = "images/mastheadImage.gif"
-        itemTag['media-type'] = 'image/gif'
-        manifest.insert(mtc, itemTag)
-        mtc += 1
+        opf.start('metadata', [('xmlns:dc', "http://purl.org/dc/elements/1.1/"),
+                               ('xmlns:opf', "http://www.idpf.org/2007/opf"),
+                               ('xmlns:calibre', "http://calibre.kovidgoyal.net/2009/metadata"),
+                               ('xmlns:xsi', "http://www.w3.org/2001/XMLSchema-instance")])
+        opf.element('dc:title', text=escape(self.opts.catalog_title))
+        opf.element('dc:creator', text=self.opts.creator)
+        opf.element('meta', [('name', "calibre:publication_type"),
+                             ('content', "periodical:default")])
+        opf.element('dc:language', text='en-US')
+        opf.end()
+
+        # Manifest
+        opf.start('manifest')
+        opf.element('item', [('id', "ncx"),
+                             ('href', '%s.ncx' % self.opts.basename),
+                             ('media-type', "application/x-dtbncx+xml")])
+        opf.element('item', [('id', 'stylesheet'),
+                             ('href', self.stylesheet),
+                             ('media-type', 'text/css')])
+        opf.element('item', [('id', 'mastheadimage-image'),
+                             ('href', "images/mastheadImage.gif"),
+                             ('media-type', 'image/gif')])
 
         # Write the thumbnail images, descriptions to the manifest
         for thumb in self.thumbs:
-            itemTag = Tag(soup, "item")
-            itemTag['href'] = "images/%s" % (thumb)
             end = thumb.find('.jpg')
-            itemTag['id'] = "%s-image" % thumb[:end]
-            itemTag['media-type'] = 'image/jpeg'
-            manifest.insert(mtc, itemTag)
-            mtc += 1
-
-        # Add html_files to manifest and spine
-
-        for file in self.html_filelist_1:
-            # By Author, By Title, By Series,
-            itemTag = Tag(soup, "item")
-            start = file.find('/') + 1
-            end = file.find('.')
-            itemTag['href'] = file
-            itemTag['id'] = file[start:end].lower()
-            itemTag['media-type'] = "application/xhtml+xml"
-            manifest.insert(mtc, itemTag)
-            mtc += 1
-
-            # spine
-            itemrefTag = Tag(soup, "itemref")
-            itemrefTag['idref'] = file[start:end].lower()
-            spine.insert(stc, itemrefTag)
-            stc += 1
-
-        # Add genre files to manifest and spine
-        for genre in self.genres:
-            itemTag = Tag(soup, "item")
-            start = genre['file'].find('/') + 1
-            end = genre['file'].find('.')
-            itemTag['href'] = genre['file']
-            itemTag['id'] = genre['file'][start:end].lower()
-            itemTag['media-type'] = "application/xhtml+xml"
-            manifest.insert(mtc, itemTag)
-            mtc += 1
-
-            # spine
-            itemrefTag = Tag(soup, "itemref")
-            itemrefTag['idref'] = genre['file'][start:end].lower()
-            spine.insert(stc, itemrefTag)
-            stc += 1
-
-        for file in self.html_filelist_2:
-            # By Date Added, By Date Read
-            itemTag = Tag(soup, "item")
-            start = file.find('/') + 1
-            end = file.find('.')
-            itemTag['href'] = file
-            itemTag['id'] = file[start:end].lower()
-            itemTag['media-type'] = "application/xhtml+xml"
-            manifest.insert(mtc, itemTag)
-            mtc += 1
-
-            # spine
-            itemrefTag = Tag(soup, "itemref")
-            itemrefTag['idref'] = file[start:end].lower()
-            spine.insert(stc, itemrefTag)
-            stc += 1
-
-        for book in self.books_by_description:
-            # manifest
-            itemTag = Tag(soup, "item")
-            itemTag['href'] = "content/book_%d.html" % int(book['id'])
-            itemTag['id'] = "book%d" % int(book['id'])
-            itemTag['media-type'] = "application/xhtml+xml"
-            manifest.insert(mtc, itemTag)
-            mtc += 1
-
-            # spine
-            itemrefTag = Tag(soup, "itemref")
-            itemrefTag['idref'] = "book%d" % int(book['id'])
-            spine.insert(stc, itemrefTag)
-            stc += 1
+            opf.element('item', [('href', "images/%s" % (thumb)),
+                                 ('id', "%s-image" % thumb[:end]),
+                                 ('media-type', 'image/jpeg')])
+
+        # Add html_files to manifest
+        for href, id in _content_files():
+            opf.element('item', [('href', href),
+                                 ('id', id),
+                                 ('media-type', "application/xhtml+xml")])
+        opf.end()
+
+        # Spine
+        opf.start('spine', [('toc', "ncx")])
+        for href, id in _content_files():
+            opf.element('itemref', [('idref', id)])
+        opf.end()
 
         # Guide
-        referenceTag = Tag(soup, "reference")
-        referenceTag['type'] = 'masthead'
-        referenceTag['title'] = 'mastheadimage-image'
-        referenceTag['href'] = 'images/mastheadImage.gif'
-        guide.insert(0, referenceTag)
+        opf.start('guide')
+        opf.element('reference', [('type', 'masthead'),
+                                  ('title', 'mastheadimage-image'),
+                                  ('href', 'images/mastheadImage.gif')])
+        opf.end()
 
         # Write the OPF file
-        outfile = open("%s/%s.opf" % (self.catalog_path, self.opts.basename), 'w')
-        outfile.write(soup.prettify())
+        opf.close()
+
+    def generate_output_fingerprint(self, data):
+        """ Generate a digest of everything the converted catalog depends on.
+
+        Settings, templates and stylesheet, conversion recommendations and
+        the books fetched for the catalog: ids in catalog order, last
+        modification and the metadata fingerprint of each book.
+
+        Args:
+         data (list): book metadata dicts from fetch_catalog_data(),
+          updated with their 'fingerprint'
+
+        Return:
+         (str): hex digest
+        """
+        values = [self.generate_settings_fingerprint(), self.opts.exclusion_tags,
+                  self.opts.fmt, self.opts.use_existing_cover,
+                  self.plugin.CONVERSION_RECOMMENDATIONS]
+        for record in data:
+            record['fingerprint'] = self.generate_book_fingerprint(record)
+            last_modified = record.get('last_modified')
+            if hasattr(last_modified, 'isoformat'):
+                last_modified = last_modified.isoformat()
+            values.append((record['id'], last_modified, record['fingerprint']))
+        return hashlib.md5(repr(values)).hexdigest()
 
     def generate_rating_string(self, book):
         """ Generate rating string for Descriptions.
@@ -2260,6 +2464,31 @@ class CatalogBuilder(object):
         else:
             return "%s_series" % re.sub('\W', '', ascii_text(series)).lower()
 
+    def generate_settings_fingerprint(self):
+        """ Generate a digest of the settings shared by all catalog pages.
+
+        Options, genre anchors, templates and stylesheet affect every page.
+        A previous build manifest with a different settings fingerprint
+        can't be reused.
+
+        Inputs:
+         opts (object): build options
+         genre_tags_dict (dict): friendly to normalized genre tags
+
+        Return:
+         (str): hex digest
+        """
+        values = [self.plugin.version, self.library_base_path, get_lang(),
+                  self.opts.author_clip, self.opts.catalog_title,
+                  self.opts.description_clip, self.opts.descriptions_per_file,
+                  self.opts.generate_series,
+                  self.opts.library_url, self.opts.output_profile,
+                  self.opts.thumb_width, sorted(self.genre_tags_dict.items())]
+        for resource in self.PAGE_RESOURCES:
+            data = self.load_userfile_or_pluginfile(resource)
+            values.append(hashlib.md5(data).hexdigest())
+        return hashlib.md5(repr(values)).hexdigest()
+
     def generate_short_description(self, description, dest=None):
         """ Generate a truncated version of the supplied string.
 
@@ -2306,6 +2535,37 @@ class CatalogBuilder(object):
             print " returning description with unspecified destination '%s'" % description
             raise RuntimeError
 
+    def generate_sort_keys(self, book):
+        """ Precompute the sort keys of a book.
+
+        Sort components and ICU collation keys are computed once per record,
+        every ordering of the catalog reuses them. Sort titles of series are
+        shared by the books of a series.
+
+        Args:
+         book (CatalogBook): book metadata, with title_sort, author_sort and series
+
+        Updated:
+         book (CatalogBook): sort_author, sort_title, sort_series, sort_series_index,
+          title_sort_key, series_sort_key added
+        """
+        book['sort_author'] = capitalize(book['author_sort'])
+        book['sort_title'] = capitalize(book['title_sort'])
+        book['title_sort_key'] = sort_key(book['title_sort'].upper())
+        if book['series']:
+            if book['series'] not in self.series_sort_titles:
+                self.series_sort_titles[book['series']] = self.generate_sort_title(book['series'])
+            index = book['series_index']
+            integer = int(index)
+            fraction = index - integer
+            book['sort_series'] = self.series_sort_titles[book['series']]
+            book['sort_series_index'] = '%04d%s' % (integer, str('%0.4f' % fraction).lstrip('0'))
+            book['series_sort_key'] = sort_key(self._kf_books_by_series_sorter(book))
+        else:
+            book['sort_series'] = None
+            book['sort_series_index'] = None
+            book['series_sort_key'] = None
+
     def generate_sort_title(self, title):
         """ Generates a sort string from title.
 
@@ -2366,7 +2626,7 @@ class CatalogBuilder(object):
     def generate_thumbnail(self, title, image_dir, thumb_file):
         """ Create thumbnail of cover or return previously cached thumb.
 
-        Test thumb archive for currently cached cover. Return cached version, or create
+        Test thumb store for currently cached cover. Return cached version, or create
         and cache new version. Uses calibre.utils.magick.draw to generate thumbnail from
         cover.
 
@@ -2377,59 +2637,37 @@ class CatalogBuilder(object):
 
         Output:
          (file): thumb written to /images
-         (archive): current thumb archived under cover crc
+         (store): current thumb stored under uuid, cover crc
         """
 
-        def _open_archive(mode='r'):
-            try:
-                return ZipFile(self.thumbs_path, mode=mode, allowZip64=True)
-            except:
-                # occurs under windows if the file is opened by another
-                # process
-                pass
+        # Get crc for current cover, reading it only if changed
+        cover_crc, data, cover_stat = self.get_cover_crc(title)
+        if data is not None:
+            self.thumbs_cache.set_cover_fingerprint(title['uuid'], *(cover_stat + (cover_crc,)))
+
+        # Test cache for uuid with matching crc
+        thumb_data = self.thumbs_cache.get(title['uuid'], cover_crc)
+        if thumb_data is None:
+            if data is None:
+                with open(title['cover'], 'rb') as f:
+                    data = f.read()
+            # Save thumb for catalog. If invalid data, error returns to generate_thumbnails()
+            thumb_data = thumbnail(data,
+                    width=self.thumb_width, height=self.thumb_height)[-1]
+            self.thumbs_cache.put(title['uuid'], cover_crc, thumb_data)
 
-        # Generate crc for current cover
-        with open(title['cover'], 'rb') as f:
-            data = f.read()
-        cover_crc = hex(zlib.crc32(data))
-
-        # Test cache for uuid
-        zf = _open_archive()
-        if zf is not None:
-            with zf:
-                try:
-                    zf.getinfo(title['uuid'] + cover_crc)
-                except:
-                    pass
-                else:
-                    # uuid found in cache with matching crc
-                    thumb_data = zf.read(title['uuid'] + cover_crc)
-                    with open(os.path.join(image_dir, thumb_file), 'wb') as f:
-                        f.write(thumb_data)
-                    return
-
-        # Save thumb for catalog. If invalid data, error returns to generate_thumbnails()
-        thumb_data = thumbnail(data,
-                width=self.thumb_width, height=self.thumb_height)[-1]
         with open(os.path.join(image_dir, thumb_file), 'wb') as f:
             f.write(thumb_data)
 
-        # Save thumb to archive
-        if zf is not None:
-            # Ensure that the read succeeded
-            # If we failed to open the zip file for reading,
-            # we dont know if it contained the thumb or not
-            zf = _open_archive('a')
-            if zf is not None:
-                with zf:
-                    zf.writestr(title['uuid'] + cover_crc, thumb_data)
-
     def generate_thumbnails(self):
         """ Generate a thumbnail cover for each book.
 
         Generate or retrieve a thumbnail for each cover. If nonexistent or faulty
         cover data, substitute default cover. Checks for updated default cover.
-        At completion, writes self.opts.thumb_width to archive.
+        At completion, validates thumbs of the current dimensions in the store
+        and starts compact_thumbs_cache() in the background.
+        With opts.worker_count > 1, covers are read and resized by a pool of
+        worker processes first, see generate_thumbnails_parallel().
 
         Inputs:
          books_by_title (list): books to catalog
@@ -2438,20 +2676,47 @@ class CatalogBuilder(object):
          thumbs (list): list of referenced thumbnails
         """
 
+        def _reusable(title, thumb_file):
+            # Reuse the thumb from the previous build if unchanged
+            previous = self.get_previous_book_entry(title)
+            return (previous is not None and previous.get('thumb') and
+                    os.path.exists(os.path.join(image_dir, thumb_file)))
+
         self.update_progress_full_step(_("Thumbnails"))
         thumbs = ['thumbnail_default.jpg']
         image_dir = "%s/images" % self.catalog_path
+
+        generated = None
+        if self.opts.worker_count > 1 and hasattr(os, 'fork'):
+            # Books with unchanged, cached covers are left to generate_thumbnail()
+            pending = [i for (i, title) in enumerate(self.books_by_title)
+                       if not _reusable(title, 'thumbnail_%d.jpg' % int(title['id'])) and
+                          not self.is_cover_current(title)]
+            if len(pending) > self.RENDER_CHUNK_SIZE:
+                generated = self.generate_thumbnails_parallel(pending, image_dir)
+
         for (i, title) in enumerate(self.books_by_title):
             # Update status
-            self.update_progress_micro_step("%s %d of %d" %
-                (_("Thumbnail"), i, len(self.books_by_title)),
-                 i / float(len(self.books_by_title)))
+            if generated is None:
+                self.update_progress_micro_step("%s %d of %d" %
+                    (_("Thumbnail"), i, len(self.books_by_title)),
+                     i / float(len(self.books_by_title)))
 
             thumb_file = 'thumbnail_%d.jpg' % int(title['id'])
+
+            if _reusable(title, thumb_file):
+                self.build_manifest['books'][str(title['id'])]['thumb'] = True
+                self.thumbs_cache.touch(title['uuid'])
+                thumbs.append(thumb_file)
+                continue
+
             thumb_generated = True
             valid_cover = True
             try:
-                self.generate_thumbnail(title, image_dir, thumb_file)
+                if generated is None or i not in generated:
+                    self.generate_thumbnail(title, image_dir, thumb_file)
+                elif not generated[i]:
+                    raise RuntimeError("no thumbnail generated for '%s'" % title['title'])
                 thumbs.append("thumbnail_%d.jpg" % int(title['id']))
             except:
                 if 'cover' in title and os.path.exists(title['cover']):
@@ -2493,13 +2758,81 @@ class CatalogBuilder(object):
                 # Clear the book's cover property
                 title['cover'] = None
 
-        # Write thumb_width to the file, validating cache contents
+            if self.incremental:
+                self.build_manifest['books'][str(title['id'])]['thumb'] = thumb_generated
+
+        # Validate cache contents for the current thumb dimensions
         # Allows detection of aborted catalog builds
-        with ZipFile(self.thumbs_path, mode='a') as zfw:
-            zfw.writestr('thumb_width', self.opts.thumb_width)
+        self.thumbs_cache.set_valid()
+        self.thumbs_cache.close()
 
         self.thumbs = thumbs
 
+    def generate_thumbnails_parallel(self, pending, image_dir):
+        """ Read and resize covers using a process pool.
+
+        Chunks of books are handed to forked worker processes, which read each
+        cover, compute its crc and resize covers missing from the thumb store.
+        Workers test cache hits against the index of the store inherited from
+        the parent. The parent process is the single owner of the store: it
+        copies cached thumbs, writes each thumb to image_dir and adds new
+        thumbs to the store as chunks complete. Failed covers are left to
+        generate_thumbnails() for default cover substitution.
+
+        Args:
+         pending (list): indices into books_by_title of books needing a thumb
+         image_dir (str): directory to write thumbs to
+
+        Output:
+         (files): thumbs written to /images
+         (store): new thumbs stored under uuid, cover crc
+
+        Return:
+         (dict): index into books_by_title: True if thumb written
+        """
+        global _worker_builder
+
+        chunks = [pending[i:i + self.RENDER_CHUNK_SIZE]
+                  for i in range(0, len(pending), self.RENDER_CHUNK_SIZE)]
+        workers = min(self.opts.worker_count, len(chunks))
+        if self.opts.verbose:
+            self.opts.log.info("  generating %d thumbnails in %d chunks, %d workers" %
+                               (len(pending), len(chunks), workers))
+
+        generated = {}
+        completed = len(self.books_by_title) - len(pending)
+        _worker_builder = self
+        pool = Pool(processes=workers)
+        try:
+            for rendered in pool.imap_unordered(_render_thumbnails, chunks):
+                for (title_num, cover_crc, cover_stat, thumb_data) in rendered:
+                    generated[title_num] = False
+                    if cover_crc is None:
+                        continue
+                    title = self.books_by_title[title_num]
+                    self.thumbs_cache.set_cover_fingerprint(title['uuid'], *(cover_stat + (cover_crc,)))
+                    if thumb_data is None:
+                        # uuid found in cache with matching crc
+                        thumb_data = self.thumbs_cache.get(title['uuid'], cover_crc)
+                    else:
+                        self.thumbs_cache.put(title['uuid'], cover_crc, thumb_data)
+                    thumb_file = 'thumbnail_%d.jpg' % int(title['id'])
+                    with open(os.path.join(image_dir, thumb_file), 'wb') as f:
+                        f.write(thumb_data)
+                    generated[title_num] = True
+                completed += len(rendered)
+                self.update_progress_micro_step("%s %d of %d" %
+                    (_("Thumbnail"), completed, len(self.books_by_title)),
+                     completed / float(len(self.books_by_title)))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _worker_builder = None
+        return generated
+
     def generate_unicode_name(self, c):
         """ Generate a legal XHTML anchor from unicode character.
 
@@ -2515,6 +2848,56 @@ class CatalogBuilder(object):
         terms = fullname.split()
         return "_".join(terms)
 
+    def get_cached_output(self):
+        """ Return the output of the previous build if its inputs are unchanged.
+
+        Outputs are cached per output profile in the locked cache directory.
+        Volumes, pipeline debugging and covers taken from the library are
+        not cached.
+
+        Inputs:
+         output_fingerprint (str): digest of this build's inputs
+
+        Return:
+         (str): path of the cached output, None if the catalog must be built
+        """
+        if (self.cache_lock is None or getattr(self.opts, 'volume', None) or
+                getattr(self.opts, 'debug_pipeline', None) is not None or
+                self.opts.use_existing_cover):
+            return None
+        output_path = self.get_output_cache_path()
+        try:
+            with open(output_path + '.json', 'rb') as f:
+                fingerprint = json.load(f)['fingerprint']
+        except:
+            return None
+        if fingerprint != self.output_fingerprint or not os.path.exists(output_path):
+            return None
+        return output_path
+
+    def get_cover_crc(self, title):
+        """ Get crc of a book's cover, reading the cover only if changed.
+
+        Covers whose path, size and mtime match those recorded in the thumbs
+        store are not read, the recorded crc is returned. Otherwise the cover
+        is read and hashed, the caller records the new crc.
+
+        Args:
+         title (dict): book metadata
+
+        Return:
+         (tuple): (cover_crc, data, cover_stat), data None if the cover was not
+          read, cover_stat (path, size, mtime) sampled before reading
+        """
+        st = os.stat(title['cover'])
+        cover_stat = (title['cover'], st.st_size, st.st_mtime)
+        cover_crc = self.thumbs_cache.get_cover_fingerprint(title['uuid'], *cover_stat)
+        if cover_crc is not None:
+            return (cover_crc, None, cover_stat)
+        with open(title['cover'], 'rb') as f:
+            data = f.read()
+        return (hex(zlib.crc32(data)), data, cover_stat)
+
     def get_excluded_tags(self):
         """ Get excluded_tags from opts.exclusion_rules.
 
@@ -2547,19 +2930,74 @@ class CatalogBuilder(object):
     def get_friendly_genre_tag(self, genre):
         """ Return the first friendly_tag matching genre.
 
-        Scan self.genre_tags_dict[] for first friendly_tag matching genre.
-       genre_tags_dict[] populated in filter_genre_tags().
+        Look up genre in self.friendly_genre_tags, populated with
+        genre_tags_dict[] in filter_genre_tags().
 
         Args:
          genre (str): genre to match
 
         Return:
-         friendly_tag (str): friendly_tag matching genre
+         friendly_tag (str): friendly_tag matching genre, None if no match
+        """
+        return self.friendly_genre_tags.get(genre)
+
+    def get_resource_mtime(self, name):
+        """ Return the mtime of the user override of a resource.
+
+        Args:
+         name (str): resource name, e.g. 'magic_catalog/magic_stylesheet.css'
+
+        Return:
+         (float): mtime of config_dir/resources/name, None if not overridden
+        """
+        try:
+            return os.path.getmtime(os.path.join(config_dir, 'resources', name))
+        except OSError:
+            return None
+
+    def get_template_renderer(self, name):
+        """ Return the render callable of a compiled template.
+
+        Templates are loaded and compiled once per build. A compiled template
+        is discarded when the user override file in config_dir/resources is
+        added, removed or changes mtime.
+
+        Args:
+         name (str): template name, e.g. 'magic_catalog/magic_template.xhtml'
+
+        Return:
+         (callable): render() of the compiled Templite
         """
-        # Find the first instance of friendly_tag matching genre
-        for friendly_tag in self.genre_tags_dict:
-            if self.genre_tags_dict[friendly_tag] == genre:
-                return friendly_tag
+        mtime = self.get_resource_mtime(name)
+        compiled = self.compiled_templates.get(name)
+        if compiled is None or compiled[0] != mtime:
+            template = self.load_userfile_or_pluginfile(name).decode('utf-8')
+            compiled = (mtime, Templite(template).render)
+            self.compiled_templates[name] = compiled
+        return compiled[1]
+
+    def get_previous_book_entry(self, book):
+        """ Return the previous build manifest entry of an unchanged book.
+
+        Args:
+         book (dict): book metadata
+
+        Return:
+         (dict): manifest entry from the previous build, or None if not
+          building incrementally or the book was added or changed
+        """
+        if not self.incremental or book['id'] in self.changed_book_ids:
+            return None
+        return self.previous_manifest['books'].get(str(book['id']))
+
+    def get_output_cache_path(self):
+        """ Return the path of the cached output of the current output profile.
+
+        Return:
+         (str): cache_dir/output/<output profile>.<fmt>
+        """
+        return os.path.join(self.cache_dir, 'output',
+                            '%s.%s' % (self.opts.output_profile, self.opts.fmt))
 
     def get_output_profile(self, _opts):
         """ Return profile matching opts.output_profile
@@ -2574,6 +3012,53 @@ class CatalogBuilder(object):
             if profile.short_name == _opts.output_profile:
                 return profile
 
+    def is_cover_current(self, title):
+        """ Test for an unchanged cover with a cached thumb.
+
+        Only the cover's stat data is consulted, the cover is not read.
+
+        Args:
+         title (dict): book metadata
+
+        Return:
+         (bool): True if the thumb can be copied from the thumbs store
+        """
+        try:
+            st = os.stat(title['cover'])
+        except:
+            return False
+        cover_crc = self.thumbs_cache.get_cover_fingerprint(title['uuid'],
+                        title['cover'], st.st_size, st.st_mtime)
+        return cover_crc is not None and (title['uuid'], cover_crc) in self.thumbs_cache
+
+    def is_section_current(self, outfile_spec, args):
+        """ Test whether a section page from the previous build can be reused.
+
+        Record a digest of the template arguments of a section page in the
+        build manifest, compare with the digest of the previous build.
+
+        Args:
+         outfile_spec (str): full pathname to section page
+         args (dict): template arguments
+
+        Return:
+         (bool): True if outfile_spec was rendered from identical arguments
+        """
+        def _book_fields(book):
+            # Book records listed in args, digested by every field a
+            # customized template can read, derived ones included. The
+            # description fields are covered by the metadata fingerprint.
+            return [(key, repr(book[key])) for key in sorted(book.keys())
+                    if key not in ('description', 'short_description')]
+
+        if not self.incremental:
+            return False
+        section = os.path.basename(outfile_spec)
+        digest = hashlib.md5(json.dumps(args, sort_keys=True, default=_book_fields)).hexdigest()
+        self.build_manifest['sections'][section] = digest
+        return (self.previous_manifest['sections'].get(section) == digest and
+                os.path.exists(outfile_spec))
+
     def letter_or_symbol(self, char):
         """ Test asciized char for A-z.
 
@@ -2590,6 +3075,57 @@ class CatalogBuilder(object):
         else:
             return char
 
+    def load_build_manifest(self):
+        """ Load the manifest of the previous incremental build.
+
+        The manifest maps each book id to the fingerprint of the metadata its
+        pages were rendered from. A manifest written with different settings
+        is discarded, forcing a full rebuild.
+
+        Inputs:
+         catalog_path (path): persistent build directory
+         books_to_catalog (list): books with fingerprints
+
+        Outputs:
+         previous_manifest (dict): manifest of the previous build
+         build_manifest (dict): manifest of this build
+         changed_book_ids (set): books added or changed since previous build
+        """
+        if not self.incremental:
+            return
+
+        settings = self.generate_settings_fingerprint()
+        manifest_path = os.path.join(self.catalog_path, 'manifest.json')
+        previous = None
+        try:
+            with open(manifest_path, 'rb') as f:
+                previous = json.load(f)
+        except:
+            self.opts.log.info(" no previous build manifest at '%s'" % manifest_path)
+        else:
+            if (previous.get('version') != self.BUILD_MANIFEST_VERSION or
+                    previous.get('settings') != settings):
+                self.opts.log.warning(" catalog settings changed, regenerating all sources")
+                previous = None
+        if previous is None:
+            previous = {'books': {}, 'sections': {}}
+
+        self.previous_manifest = previous
+        self.build_manifest = {'version': self.BUILD_MANIFEST_VERSION,
+                               'settings': settings,
+                               'books': {},
+                               'sections': {}}
+        for book in self.books_to_catalog:
+            entry = previous['books'].get(str(book['id']))
+            if entry is None or entry['fingerprint'] != book['fingerprint']:
+                self.changed_book_ids.add(book['id'])
+            self.build_manifest['books'][str(book['id'])] = {'fingerprint': book['fingerprint']}
+
+        removed = set(previous['books']) - set(self.build_manifest['books'])
+        self.opts.log.info(" incremental build: %d added or changed, %d removed, %d unchanged" %
+                           (len(self.changed_book_ids), len(removed),
+                            len(self.books_to_catalog) - len(self.changed_book_ids)))
+
     def massage_comments(self, comments):
         """ Massage comments to somewhat consistent format.
 
@@ -2711,6 +3247,41 @@ class CatalogBuilder(object):
 
         return result.renderContents(encoding=None)
 
+    def lock_cache_dir(self):
+        """ Lock the persistent catalog caches of the library.
+
+        Caches are kept per library in cache_dir()/magic_mobi_catalog/<library id>,
+        build sources per output profile below it. A lock file keeps concurrent
+        catalog jobs of the same library out of each other's caches until
+        release_cache_dir(). If another job holds the lock past
+        CACHE_LOCK_TIMEOUT, a temporary cache directory is used instead and
+        incremental building is disabled.
+
+        Inputs:
+         library_base_path (str): path to the calibre library
+
+        Outputs:
+         cache_lock (ExclusiveFile): held lock, or None
+
+        Return:
+         (str): cache directory
+        """
+        library_cache_dir = os.path.join(cache_dir(), 'magic_mobi_catalog',
+                                         self.generate_library_id())
+        if not os.path.isdir(library_cache_dir):
+            os.makedirs(library_cache_dir)
+        lock = ExclusiveFile(os.path.join(library_cache_dir, 'lock'),
+                             timeout=self.CACHE_LOCK_TIMEOUT)
+        try:
+            lock.__enter__()
+        except LockError:
+            self.opts.log.warning(" catalog cache at %s is in use by another catalog job" %
+                                  library_cache_dir)
+            self.opts.log.warning(" using a temporary cache, thumbnails are regenerated")
+            return PersistentTemporaryDirectory("_magic_mobi_cache", prefix='')
+        self.cache_lock = lock
+        return library_cache_dir
+
     def merge_comments(self, record):
         """ Merge comments with custom column content.
 
@@ -2734,19 +3305,85 @@ class CatalogBuilder(object):
 
         return merged
 
+    def normalize_comments(self, comments):
+        """ Generate description HTML and text from comments.
+
+        Plain text comments are normalized in a single pass, producing the
+        markup massage_comments() generates for them: lost CRs and blank lines
+        split paragraphs, remaining line breaks become <br />, '--' becomes an
+        em dash. Comments with markup or entities are tokenized once by
+        tokenize_comments(), markup it leaves alone goes through
+        massage_comments().
+
+        Args:
+         comments (str): comments from metadata, annotations removed
+
+        Return:
+         (tuple): (description HTML, text of description paragraphs)
+        """
+        if not isinstance(comments, unicode):
+            comments = comments.decode('utf-8', 'replace')
+
+        if ('<' in comments or '>' in comments or '&' in comments or
+                not comments.strip(u' \t\n\x0c\r')):
+            normalized = self.tokenize_comments(comments)
+            if normalized is not None:
+                return normalized
+            description = self.massage_comments(comments)
+            paras = BeautifulSoup(description).findAll('p')
+            tokens = []
+            for p in paras:
+                for token in p.contents:
+                    if token.string is not None:
+                        tokens.append(token.string)
+            return (description, ' '.join(tokens))
+
+        # Explode lost CRs to \n\n
+        comments = re.sub('([a-z])([\.\?!])([A-Z])', u'\\1\\2\n\n\\3', comments)
+
+        paras = []
+        tokens = []
+        for para in comments.split(u'\n\n'):
+            lines = para.replace(u'\r', u'\n').split(u'\n')
+            for (i, line) in enumerate(lines):
+                if line:
+                    if not line.strip(u' \t\x0c'):
+                        # Whitespace-only strings collapse as in BeautifulSoup
+                        line = u' '
+                    else:
+                        line = line.replace(u'--', u'\u2014')
+                    lines[i] = line
+                    tokens.append(line)
+            paras.append(u'<p class="description">%s</p>' % u'<br />'.join(lines))
+        return (u''.join(paras), u' '.join(tokens))
+
+    def release_cache_dir(self):
+        """ Release the lock on the persistent catalog caches.
+
+        Called once the catalog has been converted, as the conversion reads
+        the build sources.
+
+        Outputs:
+         cache_lock (ExclusiveFile): released
+        """
+        if self.cache_lock is not None:
+            self.cache_lock.__exit__(None, None, None)
+            self.cache_lock = None
+
     def relist_multiple_authors(self, books_by_author):
         """ Create multiple entries for books with multiple authors
 
         Given a list of books by author, scan list for books with multiple
-        authors. Add a cloned copy of the book per additional author.
+        authors. Add an AuthorView of the book per additional author, sharing
+        the book record and overriding its author fields.
 
         Args:
          books_by_author (list): book list possibly containing books
          with multiple authors
 
         Return:
-         (list): books_by_author with additional cloned entries for books with
-         multiple authors
+         (list): books_by_author with additional AuthorView entries for books
+         with multiple authors
         """
 
         multiple_author_books = []
@@ -2762,15 +3399,286 @@ class CatalogBuilder(object):
                 if x:
                     first_author = cloned_authors.pop(0)
                     cloned_authors.append(first_author)
-                    new_book = deepcopy(book)
-                    new_book['author'] = ' & '.join(cloned_authors)
-                    new_book['authors'] = list(cloned_authors)
                     asl = [author_to_author_sort(auth) for auth in cloned_authors]
-                    new_book['author_sort'] = ' & '.join(asl)
+                    author_sort = ' & '.join(asl)
+                    new_book = AuthorView(book,
+                                          author=' & '.join(cloned_authors),
+                                          authors=list(cloned_authors),
+                                          author_sort=author_sort,
+                                          sort_author=capitalize(author_sort))
                     books_by_author.append(new_book)
 
         return books_by_author
 
+    def render_thumbnail(self, title):
+        """ Read and resize a cover in a thumbnail worker process.
+
+        Args:
+         title (dict): book metadata
+
+        Return:
+         (tuple): (cover_crc, cover_stat, thumb_data), thumb_data None if
+          already in the thumbs store
+        """
+        cover_crc, data, cover_stat = self.get_cover_crc(title)
+        if (title['uuid'], cover_crc) in self.thumbs_cache:
+            return (cover_crc, cover_stat, None)
+        if data is None:
+            with open(title['cover'], 'rb') as f:
+                data = f.read()
+        return (cover_crc, cover_stat, thumbnail(data,
+                width=self.thumb_width, height=self.thumb_height)[-1])
+
+    def remove_stale_sources(self):
+        """ Remove sources of the previous build no longer part of the catalog.
+
+        Descriptions and thumbs of removed books, and pages of sections no
+        longer generated, are deleted from the persistent build directory.
+
+        Inputs:
+         html_filelist_1, html_filelist_2, genres, description_files,
+         thumbs: sources referenced by this build
+
+        Output:
+         (files): unreferenced content/*.html, images/thumbnail_*.jpg removed
+        """
+        referenced = set(os.path.basename(f) for f in self.html_filelist_1 + self.html_filelist_2)
+        referenced.update(os.path.basename(genre['file']) for genre in self.genres)
+        referenced.update(file_name for (file_name, item_id, books) in self.description_files)
+        for f in os.listdir(self.content_dir):
+            if f.endswith('.html') and f not in referenced:
+                os.remove(os.path.join(self.content_dir, f))
+
+        image_dir = os.path.join(self.catalog_path, 'images')
+        referenced = set(self.thumbs)
+        for f in os.listdir(image_dir):
+            if f.startswith('thumbnail_') and f not in referenced:
+                os.remove(os.path.join(image_dir, f))
+
+    def save_build_manifest(self):
+        """ Save the build manifest for the next incremental build.
+
+        Written only after all sources have been generated, so an aborted build
+        leaves the manifest of the last complete build in place.
+
+        Inputs:
+         build_manifest (dict): manifest of this build
+
+        Output:
+         catalog_path/manifest.json (file)
+        """
+        manifest_path = os.path.join(self.catalog_path, 'manifest.json')
+        with open(manifest_path + '.tmp', 'wb') as f:
+            json.dump(self.build_manifest, f)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        os.rename(manifest_path + '.tmp', manifest_path)
+
+    def save_output(self, path_to_output):
+        """ Cache the converted catalog for the next build.
+
+        The fingerprint is written after the output, an interrupted copy
+        leaves no fingerprint to match.
+
+        Args:
+         path_to_output (str): converted catalog
+
+        Inputs:
+         output_fingerprint (str): digest of this build's inputs
+
+        Output:
+         cache_dir/output/<output profile>.<fmt>[.json] (files)
+        """
+        if self.cache_lock is None or getattr(self.opts, 'volume', None):
+            return
+        output_path = self.get_output_cache_path()
+        if not os.path.isdir(os.path.dirname(output_path)):
+            os.makedirs(os.path.dirname(output_path))
+        if os.path.exists(output_path + '.json'):
+            os.remove(output_path + '.json')
+        shutil.copyfile(path_to_output, output_path)
+        with open(output_path + '.json', 'wb') as f:
+            json.dump({'fingerprint': self.output_fingerprint}, f)
+
+    def tokenize_comments(self, comments):
+        """ Generate description HTML and text from marked-up comments.
+
+        Produces what massage_comments() and a parse of its result produce,
+        tokenizing the comments once. The token tree is written as
+        BeautifulSoup writes it: <div>s are moved after the paragraphs, line
+        breaks become <br />, '--' becomes an em dash, and top level text
+        and inline tags are wrapped in paragraphs. Paragraph text is
+        collected from the same tree. Markup BeautifulSoup would restructure
+        or write differently returns None: unknown or misnested tags, nested
+        <div>s, bare '&', '<' or '>', blank lines in text.
+
+        Args:
+         comments (unicode): comments from metadata, annotations removed
+
+        Return:
+         (tuple): (description HTML, text of description paragraphs), None if
+          the comments need massage_comments()
+        """
+
+        class _Unsupported(Exception):
+            pass
+
+        def _collapse(text):
+            # Whitespace-only strings collapse as in BeautifulSoup
+            if not text.strip(u' \t\n\x0c\r'):
+                return u'\n' if u'\n' in text else u' '
+            return text
+
+        def _split_lines(children, divs):
+            # Remove <div>s, merge the text they separated, split text at
+            # line breaks
+            merged = []
+            for child in children:
+                if isinstance(child, unicode):
+                    if merged and isinstance(merged[-1], unicode):
+                        merged[-1] += child
+                    else:
+                        merged.append(child)
+                elif child[0] == 'div':
+                    divs.append(child)
+                else:
+                    merged.append([child[0], child[1], _split_lines(child[2], divs)])
+            split = []
+            for child in merged:
+                if not isinstance(child, unicode):
+                    split.append(child)
+                    continue
+                if u'\n\n' in child:
+                    raise _Unsupported
+                for (i, line) in enumerate(re.split(u'[\r\n]', child.replace(u'--', u'&mdash;'))):
+                    if i:
+                        split.append(['br', [], []])
+                    if line:
+                        split.append(_collapse(line))
+            return split
+
+        def _classify(node):
+            # Paragraphs outside <div>s get the description class
+            if isinstance(node, unicode):
+                return
+            if node[0] == 'p':
+                attrs = [(k, 'description' if k == 'class' else v) for (k, v) in node[1]]
+                if 'class' not in [k for (k, v) in attrs]:
+                    attrs.append(('class', 'description'))
+                node[1] = attrs
+            for child in node[2]:
+                _classify(child)
+
+        def _render(node):
+            if isinstance(node, unicode):
+                return node
+            (name, attrs, children) = node
+            attrs = ''.join(' %s="%s"' % attr for attr in attrs)
+            if name in self.COMMENT_VOID_TAGS:
+                return u'<%s%s />' % (name, attrs)
+            return u'<%s%s>%s</%s>' % (name, attrs, ''.join(map(_render, children)), name)
+
+        def _paragraph_tokens(node, tokens):
+            if isinstance(node, unicode):
+                return
+            if node[0] == 'p':
+                for child in node[2]:
+                    if isinstance(child, unicode):
+                        tokens.append(_collapse(child))
+                    elif len(child[2]) == 1:
+                        if not isinstance(child[2][0], unicode):
+                            # tag.string differs between BeautifulSoup versions
+                            raise _Unsupported
+                        tokens.append(_collapse(child[2][0]))
+            for child in node[2]:
+                _paragraph_tokens(child, tokens)
+
+        # Explode lost CRs to \n\n
+        comments = re.sub('([a-z])([\.\?!])([A-Z])', u'\\1\\2\n\n\\3', comments)
+
+        # Token tree, elements are [name, [(attr, value)], children]
+        root = [None, [], []]
+        stack = [root]
+        for (i, token) in enumerate(re.split(u'(<[^<>]*>)', comments)):
+            if not i % 2:
+                if not token:
+                    continue
+                if ('<' in token or '>' in token or
+                        re.search(u'&(?![a-zA-Z][a-zA-Z0-9]*;|#[0-9]+;)', token)):
+                    return None
+                stack[-1][2].append(_collapse(token))
+                continue
+
+            match = self.COMMENT_TAG.match(token)
+            if match is None:
+                return None
+            (close, name, attrs, self_closing) = match.groups()
+            name = name.lower()
+            if name not in self.COMMENT_TAGS:
+                return None
+            if close:
+                if attrs or self_closing or stack[-1][0] != name:
+                    return None
+                stack.pop()
+                continue
+
+            open_tags = [element[0] for element in stack[1:]]
+            if self_closing and name not in self.COMMENT_VOID_TAGS:
+                return None
+            if name == 'li':
+                if stack[-1][0] not in ['ol', 'ul']:
+                    return None
+            elif name == 'p' and len(stack) > 1:
+                if stack[-1][0] not in self.COMMENT_RESET_NESTING_TAGS or 'p' in open_tags:
+                    return None
+            elif name == 'div' or name not in self.COMMENT_NESTABLE_TAGS:
+                if name in open_tags:
+                    return None
+            element_attrs = []
+            for (attr, value) in re.findall(u'([a-zA-Z_][-:.a-zA-Z_0-9]*)\\s*=\\s*("[^"]*"|\'[^\']*\')', attrs):
+                value = value[1:-1]
+                if re.search(u'[&<>"\r\n]|--', value):
+                    return None
+                element_attrs.append((attr.lower(), value))
+            element = [name, element_attrs, []]
+            stack[-1][2].append(element)
+            if name not in self.COMMENT_VOID_TAGS:
+                stack.append(element)
+        if len(stack) > 1:
+            return None
+
+        try:
+            divs = []
+            nodes = _split_lines(root[2], divs)
+
+            # Wrap top level text and inline tags in paragraphs, entities in
+            # top level text become characters
+            result = []
+            para = None
+            for node in nodes:
+                if isinstance(node, unicode) or node[0] in ['br', 'b', 'i', 'em']:
+                    if para is None:
+                        para = ['p', [], []]
+                        result.append(para)
+                    if isinstance(node, unicode):
+                        node = prepare_string_for_xml(node)
+                    para[2].append(node)
+                else:
+                    para = None
+                    result.append([node[0], node[1],
+                                   [prepare_string_for_xml(child) if isinstance(child, unicode) else child
+                                    for child in node[2]]])
+            for node in result:
+                _classify(node)
+            result.extend(divs)
+
+            tokens = []
+            for node in result:
+                _paragraph_tokens(node, tokens)
+        except _Unsupported:
+            return None
+        return (u''.join(map(_render, result)), u' '.join(tokens))
+
     def update_progress_full_step(self, description):
         """ Update calibre's job status UI.
 
@@ -2815,37 +3723,94 @@ class CatalogBuilder(object):
         self.reporter(self.progress_int, self.progress_string)
 
     def write_ncx(self):
-        """ Write accumulated ncx_soup to file.
+        """ Finish the NCX file.
 
-        Expanded description
+        Close the top-level navPoint and the NCX document, sections have
+        been written as they were generated.
 
         Inputs:
-         catalog_path (str): path to generated catalog
-         opts.basename (str): catalog basename
+         ncx_writer (XMLWriter): NCX being written
 
         Output:
          (file): basename.NCX written
         """
         self.update_progress_full_step(_("Saving NCX"))
 
-        outfile = open("%s/%s.ncx" % (self.catalog_path, self.opts.basename), 'w')
-        outfile.write(self.ncx_soup.prettify())
+        self.ncx_writer.close()
+        self.ncx_writer = None
+
+    def write_ncx_label(self, ncx, text):
+        """ Write a navLabel to the NCX file.
+
+        Args:
+         ncx (XMLWriter): NCX being written
+         text (unicode): label text, None for an empty label
+        """
+        ncx.start('navLabel')
+        ncx.element('text', text=text or u'')
+        ncx.end()
+
+    def write_html_description(self, file_name, html):
+        """ Write rendered Description HTML to content_dir.
+
+        Args:
+         file_name (str): description file name, see assign_description_files()
+         html (str): rendered Description HTML
+
+        Output:
+         content/<file_name> (file)
+        """
+        outfile = open(os.path.join(self.content_dir, file_name), 'w')
+        outfile.write(html)
+        outfile.close()
+
+    def write_section_page(self, name, outfile_spec, args):
+        """ Render a section page from its compiled template, write to content_dir.
+
+        Well-formed template output is written as rendered. Otherwise the
+        output is repaired with a BeautifulStoneSoup parse/prettify round trip.
+
+        Args:
+         name (str): template name, e.g. 'magic_catalog/magic_author_template.xhtml'
+         outfile_spec (str): full pathname to output file
+         args (dict): template arguments
+
+        Output:
+         (file): section page written
+        """
+        generated_html = self.get_template_renderer(name)(**args)
+        generated_html = substitute_entites(generated_html)
+        try:
+            page = generated_html.encode('utf-8')
+            etree.fromstring(page)
+        except etree.XMLSyntaxError:
+            page = BeautifulStoneSoup(generated_html).prettify()
+
+        outfile = open(outfile_spec, 'w')
+        outfile.write(page)
+        outfile.close()
 
     def load_userfile_or_pluginfile(self, name):
         """ load file from user configuration directory or plugin-zip.
 
+        Loaded files are cached for the build. A cached file is reloaded when
+        the user override file is added, removed or changes mtime.
+
         Args:
          name  (str): load file name
 
         Return: loaded file
         """
-        user_path = os.path.join(config_dir, 'resources')
-        srcpath = os.path.join(user_path, name)
-        data = None
-        if os.path.exists(srcpath):
+        srcpath = os.path.join(config_dir, 'resources', name)
+        mtime = self.get_resource_mtime(name)
+        cached = self.resource_cache.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        if mtime is not None:
             with open(srcpath, 'rb') as f:
                 data = f.read()
         else:
             ans = self.plugin.load_resources([name])
             data = ans[name]
+        self.resource_cache[name] = (mtime, data)
         return data
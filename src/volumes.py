@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import with_statement
+
+__license__   = 'GPL v3'
+__copyright__ = '2013, yosssoy <yossoy@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import copy, hashlib, json, os, shutil
+from multiprocessing import Pool
+from urllib import quote
+from xml.sax.saxutils import escape
+
+from calibre.customize.conversion import DummyReporter
+from calibre.ebooks.oeb.base import XHTML_NS
+from calibre.library.catalogs import AuthorSortMismatchException, EmptyCatalogException
+from calibre.ptempfile import PersistentTemporaryDirectory
+from calibre.utils.filenames import ascii_text
+from calibre.utils.icu import sort_key
+from calibre_plugins.magic_mobi.generate import CatalogBuilder, book_fingerprint
+from calibre_plugins.magic_mobi.writers import XMLWriter
+
+# Volume builder inherited by forked conversion workers
+_worker_volumes = None
+
+def _convert_volume(volume_num):
+    ''' Convert the sources of a volume in a worker process '''
+    volume = _worker_volumes.volumes[volume_num]
+    _worker_volumes.plugin.convert_catalog(volume['catalog_path'], volume['path'],
+                                           volume['opts'], _worker_volumes.db)
+    return volume_num
+
+
+class VolumeBuilder(object):
+    '''
+    Catalog split into volumes.
+
+    Books are partitioned by author initial, first genre or count
+    (opts.volume_split). Each volume is a catalog of its own, generated by
+    a CatalogBuilder restricted to the volume's books and converted to
+    opts.volume_dir. Sources are generated one volume at a time, as builders
+    of a library share the locked cache directory, and copied out of it
+    before its lock is released. Volumes are then converted by a pool of
+    forked processes.
+
+    Volumes partition the books a single catalog would list, fetched and
+    filtered by a CatalogBuilder, genres are its genre tags. A volume is
+    rebuilt only if the fingerprint of its books and the catalog settings
+    differs from the one recorded by the previous build. The catalog output
+    is an index volume listing the volumes, linked through opts.volume_url.
+    '''
+
+    def __init__(self, plugin, db, opts, path_to_output, notification=DummyReporter()):
+        self.plugin = plugin
+        self.db = db
+        self.opts = opts
+        self.path_to_output = path_to_output
+        self.reporter = notification
+
+        self.basename = os.path.splitext(os.path.basename(path_to_output))[0]
+        self.error = []
+        self.manifest = {}
+        self.volume_dir = opts.volume_dir or os.path.dirname(os.path.abspath(path_to_output))
+        self.manifest_path = os.path.join(self.volume_dir, '%s_volumes.json' % self.basename)
+        self.settings = None
+        self.volumes = []
+
+    def build(self):
+        ''' Build and convert changed volumes, then the index volume '''
+        log = self.opts.log
+        if not os.path.isdir(self.volume_dir):
+            os.makedirs(self.volume_dir)
+
+        self.partition_books()
+        previous = self.load_manifest()
+
+        pending = []
+        for (volume_num, volume) in enumerate(self.volumes):
+            entry = previous.get(volume['file'])
+            if (entry is not None and entry['fingerprint'] == volume['fingerprint'] and
+                    os.path.exists(volume['path'])):
+                log.info(" volume '%s' unchanged" % volume['label'])
+                self.manifest[volume['file']] = entry
+                continue
+            if self.build_volume_sources(volume):
+                pending.append(volume_num)
+
+        self.convert_volumes(pending)
+        for volume_num in pending:
+            volume = self.volumes[volume_num]
+            self.manifest[volume['file']] = {'fingerprint': volume['fingerprint'],
+                                             'label': volume['label'],
+                                             'books': volume['books']}
+        self.remove_stale_volumes(previous)
+        self.save_manifest()
+        self.build_index()
+        return self.error
+
+    def build_index(self):
+        ''' Generate and convert the index volume to the catalog output '''
+        opts = copy.copy(self.opts)
+        index_path = PersistentTemporaryDirectory("_magic_mobi_index", prefix='')
+
+        html = XMLWriter(os.path.join(index_path, 'index.html'))
+        html.start('html', [('xmlns', XHTML_NS)])
+        html.start('head')
+        html.element('title', text=escape(opts.catalog_title))
+        html.end()
+        html.start('body')
+        html.element('h1', text=escape(opts.catalog_title))
+        html.start('ul')
+        for volume in self.volumes:
+            entry = self.manifest.get(volume['file'])
+            if entry is None:
+                continue
+            label = escape(u'%s (%d)' % (volume['label'], entry['books']))
+            html.start('li')
+            if opts.volume_url:
+                href = '%s/%s' % (opts.volume_url.rstrip('/'), quote(volume['file']))
+                html.element('a', [('href', href)], label)
+            else:
+                html.element('span', text=u'%s: %s' % (label, volume['file']))
+            html.end()
+        html.close()
+
+        ncx = XMLWriter(os.path.join(index_path, '%s.ncx' % opts.basename))
+        ncx.start('ncx', [('xmlns', "http://www.daisy.org/z3986/2005/ncx/"),
+                          ('version', "2005-1"),
+                          ('xml:lang', "en")])
+        ncx.start('navMap')
+        ncx.start('navPoint', [('id', "index"), ('playOrder', 1)])
+        ncx.start('navLabel')
+        ncx.element('text', text=escape(opts.catalog_title))
+        ncx.end()
+        ncx.element('content', [('src', "index.html")])
+        ncx.close()
+
+        opf = XMLWriter(os.path.join(index_path, '%s.opf' % opts.basename),
+                        declaration='<?xml version="1.0" encoding="UTF-8"?>')
+        opf.start('package', [('xmlns', "http://www.idpf.org/2007/opf"),
+                              ('version', "2.0"),
+                              ('unique-identifier', "calibre_id")])
+        opf.start('metadata', [('xmlns:dc', "http://purl.org/dc/elements/1.1/"),
+                               ('xmlns:opf', "http://www.idpf.org/2007/opf")])
+        opf.element('dc:title', text=escape(opts.catalog_title))
+        opf.element('dc:creator', text=opts.creator)
+        opf.element('dc:language', text='en-US')
+        opf.end()
+        opf.start('manifest')
+        opf.element('item', [('id', "ncx"),
+                             ('href', '%s.ncx' % opts.basename),
+                             ('media-type', "application/x-dtbncx+xml")])
+        opf.element('item', [('id', "index"),
+                             ('href', "index.html"),
+                             ('media-type', "application/xhtml+xml")])
+        opf.end()
+        opf.start('spine', [('toc', "ncx")])
+        opf.element('itemref', [('idref', "index")])
+        opf.close()
+
+        self.plugin.convert_catalog(index_path, self.path_to_output, opts, self.db, self.reporter)
+
+    def build_volume_sources(self, volume):
+        ''' Generate the catalog sources of a volume, False if it has none '''
+        log = self.opts.log
+        opts = copy.copy(self.opts)
+        opts.ids = volume['ids']
+        opts.catalog_title = u'%s (%s)' % (self.opts.catalog_title, volume['label'])
+        opts.use_existing_cover = False
+        opts.volume = volume['slug']
+        opts.volume_split = ''
+
+        log.info(" Begin catalog source generation of volume '%s'" % volume['label'])
+        catalog = CatalogBuilder(self.db, opts, self.plugin, report_progress=self.reporter)
+        try:
+            catalog.build_sources()
+            catalog_path = catalog.catalog_path
+            if catalog.incremental:
+                # Incremental sources live in the locked cache directory, which
+                # is released before the volumes are converted
+                catalog_path = os.path.join(
+                    PersistentTemporaryDirectory("_magic_mobi_volume", prefix=''), 'catalog')
+                shutil.copytree(catalog.catalog_path, catalog_path)
+        except (AuthorSortMismatchException, EmptyCatalogException), e:
+            log.error(" *** Skipped volume '%s': %s ***" % (volume['label'], e))
+            self.error.extend(catalog.error)
+            return False
+        except:
+            log.error(" unhandled exception in catalog generator")
+            raise
+        finally:
+            catalog.release_cache_dir()
+
+        volume['books'] = len(catalog.books_to_catalog)
+        volume['catalog_path'] = catalog_path
+        volume['opts'] = opts
+        return True
+
+    def convert_volumes(self, pending):
+        ''' Convert volumes, concurrently in forked processes if possible '''
+        global _worker_volumes
+        log = self.opts.log
+
+        workers = min(self.opts.worker_count, len(pending))
+        if workers < 2 or not hasattr(os, 'fork'):
+            for volume_num in pending:
+                volume = self.volumes[volume_num]
+                log.info(" converting volume '%s'" % volume['label'])
+                self.plugin.convert_catalog(volume['catalog_path'], volume['path'],
+                                            volume['opts'], self.db, self.reporter)
+            return
+
+        log.info(" converting %d volumes, %d workers" % (len(pending), workers))
+        _worker_volumes = self
+        pool = Pool(processes=workers)
+        try:
+            for volume_num in pool.imap_unordered(_convert_volume, pending):
+                log.info(" converted volume '%s'" % self.volumes[volume_num]['label'])
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _worker_volumes = None
+
+    def generate_fingerprint(self, label, records):
+        ''' Digest of the books and settings a volume is built from '''
+        values = [self.settings, self.plugin.CONVERSION_RECOMMENDATIONS, label]
+        values.extend(sorted(book_fingerprint(record) for record in records))
+        return hashlib.md5(repr(values)).hexdigest()
+
+    def load_manifest(self):
+        ''' Volumes of the previous build, by file name '''
+        try:
+            with open(self.manifest_path, 'rb') as f:
+                return json.load(f)
+        except:
+            return {}
+
+    def partition_books(self):
+        ''' Partition the books a single catalog would list into volumes '''
+        split = self.opts.volume_split
+        size = self.opts.volume_size
+
+        # Books, genre tags and settings as the volume builders see them
+        catalog = CatalogBuilder(self.db, copy.copy(self.opts), self.plugin,
+                                 report_progress=self.reporter,
+                                 init_resources=False, fetch_only=True)
+        try:
+            records = sorted(catalog.catalog_data,
+                             key=lambda record: sort_key(record['author_sort'] or ''))
+            genre_tags_dict = catalog.genre_tags_dict
+            self.settings = catalog.generate_settings_fingerprint()
+        finally:
+            catalog.release_cache_dir()
+
+        # [(label, slug, [records])]
+        groups = []
+        if split == 'genre':
+            # Books go to their first genre, by normalized genre tag
+            by_genre = {}
+            for record in records:
+                genres = sorted([tag for tag in record['tags'] or [] if tag in genre_tags_dict],
+                                key=sort_key)
+                by_genre.setdefault(genre_tags_dict[genres[0]] if genres else None,
+                                    []).append(record)
+            labels = dict((genre, catalog.get_friendly_genre_tag(genre))
+                          for genre in by_genre if genre is not None)
+            for genre in sorted(labels, key=lambda genre: sort_key(labels[genre])):
+                groups.append((labels[genre], genre, by_genre[genre]))
+            if None in by_genre:
+                groups.append((_('Other'), 'other', by_genre[None]))
+
+        elif split == 'author':
+            initials = []
+            for record in records:
+                initial = ascii_text((record['author_sort'] or '')[:1]).upper()
+                if not initial.isalpha():
+                    initial = '#'
+                if not initials or initials[-1][0] != initial:
+                    initials.append((initial, []))
+                initials[-1][1].append(record)
+            # Merge consecutive initials up to the target size
+            merged = []
+            for (initial, initial_records) in initials:
+                if (merged and size and
+                        len(merged[-1][2]) + len(initial_records) <= size):
+                    merged[-1][1] = initial
+                    merged[-1][2].extend(initial_records)
+                else:
+                    merged.append([initial, initial, list(initial_records)])
+            for (first, last, group) in merged:
+                label = first if first == last else u'%s-%s' % (first, last)
+                slug = label.replace('#', 'symbols').lower()
+                groups.append((label, slug, group))
+
+        else:
+            for start in range(0, len(records), size):
+                n = start // size + 1
+                groups.append((u'%d' % n, '%02d' % n, records[start:start + size]))
+
+        slugs = set()
+        for (label, slug, group) in groups:
+            # 'other' may be a genre too
+            unique = slug
+            while unique in slugs:
+                unique += '_'
+            slugs.add(unique)
+            file_name = '%s_%s.mobi' % (self.basename, unique)
+            self.volumes.append({'label': label,
+                                 'slug': unique,
+                                 'ids': [record['id'] for record in group],
+                                 'books': len(group),
+                                 'file': file_name,
+                                 'path': os.path.join(self.volume_dir, file_name),
+                                 'fingerprint': self.generate_fingerprint(label, group)})
+
+    def remove_stale_volumes(self, previous):
+        ''' Remove volumes of the previous build no longer built '''
+        for file_name in previous:
+            if file_name not in self.manifest:
+                try:
+                    os.remove(os.path.join(self.volume_dir, file_name))
+                except OSError:
+                    pass
+
+    def save_manifest(self):
+        ''' Record the volumes of this build for the next one '''
+        with open(self.manifest_path + '.tmp', 'wb') as f:
+            json.dump(self.manifest, f)
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        os.rename(self.manifest_path + '.tmp', self.manifest_path)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import with_statement
+
+__license__   = 'GPL v3'
+__copyright__ = '2013, yosssoy <yossoy@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import re
+
+
+class XMLWriter(object):
+    '''
+    Incremental XML serializer.
+
+    Elements are written to the output file as they are started, nothing
+    but the stack of open element names is held in memory. Output is
+    indented like BeautifulStoneSoup.prettify(), text and attribute values
+    are escaped the same way: brackets and ampersands not starting an
+    entity or character reference are replaced.
+    '''
+
+    BARE_AMPERSAND_OR_BRACKET = re.compile(r'([<>]|&(?!#\d+;|#x[0-9a-fA-F]+;|\w+;))')
+    ENTITIES = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+
+    def __init__(self, path, declaration='<?xml version="1.0" encoding="utf-8"?>'):
+        self.file = open(path, 'wb')
+        self.open_tags = []
+        if declaration:
+            self.file.write(declaration + '\n')
+
+    def attributes(self, attrs):
+        ''' Serialize (name, value) pairs, in the given order '''
+        out = []
+        for name, value in attrs:
+            if not isinstance(value, basestring):
+                value = unicode(value)
+            quote = '"'
+            if '"' in value:
+                quote = "'"
+                value = value.replace("'", '&apos;')
+            out.append(' %s=%s%s%s' % (name, quote, self.escape(value), quote))
+        return ''.join(out)
+
+    def close(self):
+        ''' Close open elements and the output file '''
+        while self.open_tags:
+            self.end()
+        self.file.close()
+
+    def element(self, name, attrs=(), text=None):
+        ''' Write a complete element, self-closing if it has no text '''
+        indent = ' ' * len(self.open_tags)
+        if text is None:
+            self.write('%s<%s%s />\n' % (indent, name, self.attributes(attrs)))
+        else:
+            self.write('%s<%s%s>%s</%s>\n' % (indent, name, self.attributes(attrs),
+                                              self.escape(text.strip()), name))
+
+    def end(self):
+        ''' Close the innermost open element '''
+        name = self.open_tags.pop()
+        self.write('%s</%s>\n' % (' ' * len(self.open_tags), name))
+
+    def escape(self, text):
+        return self.BARE_AMPERSAND_OR_BRACKET.sub(lambda m: self.ENTITIES[m.group(0)], text)
+
+    def start(self, name, attrs=()):
+        ''' Open an element, its children follow until end() '''
+        self.write('%s<%s%s>\n' % (' ' * len(self.open_tags), name, self.attributes(attrs)))
+        self.open_tags.append(name)
+
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        self.file.write(s)